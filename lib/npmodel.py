@@ -0,0 +1,172 @@
+"""NumPy runtime for trained time stepping models
+
+This module runs a `lib.torch.ForcedStepper` which was saved with
+`lib.torch.inference.export_numpy`. It only depends on numpy, so it starts
+quickly and uses little memory in coupled runs and evaluation jobs.
+
+Examples
+--------
+>>> model = NumpyStepper.load("model.npz")
+>>> out = model(data)
+>>> state = model.step(state, forcing, w)
+"""
+import numpy as np
+
+# specific heat of dry air
+_cp = 1004
+
+
+def mass_integrate(x, w):
+    return (x * w).sum(-1, keepdims=True)
+
+
+def enforce_precip_qt(fqt, lhf, w):
+    """Adjust the moisture tendency so that the precipitation is positive
+
+    See `lib.torch.model.enforce_precip_qt`.
+    """
+    evap = lhf * 86400 / 2.51e6
+    val_x = -mass_integrate(fqt, w) / 1000
+    val_v = -w.sum(-1) / 1000
+    alpha = np.minimum(val_x + evap, 0)
+    return fqt - alpha / val_v
+
+
+def fix_moisture(q, w, eps=1e-9):
+    """Remove negative moisture points while conserving total moisture"""
+    cond = q < eps
+    total_moisture = mass_integrate(q, w)
+    moisture_lack = mass_integrate(cond, w) * eps
+    moisture_valid = mass_integrate(np.where(cond, 0, q), w)
+    alpha = (total_moisture - moisture_lack) / moisture_valid
+    return np.where(cond, np.float32(eps), q * alpha).astype(q.dtype)
+
+
+class NumpyStepper(object):
+    """Forward Euler time stepper using an exported neural network
+
+    Parameters
+    ----------
+    weights, biases : lists of arrays
+        the layers of the network. ``weights[k]`` has shape (out, in). The
+        first layer includes the input normalization.
+    inputs : list of str
+        the inputs of the first layer, in order, as ``group/name``, e.g.
+        ``prognostic/sl`` or ``forcing/LHF``.
+    h : float
+        time step of the data
+    nsteps : int
+        number of substeps per time step
+    precip_positive : bool
+    """
+
+    def __init__(self, weights, biases, inputs, h, nsteps,
+                 precip_positive=True):
+        self.weights = [np.ascontiguousarray(w.T) for w in weights]
+        self.biases = list(biases)
+        self.inputs = [tuple(name.split('/')) for name in inputs]
+        self.h = float(h)
+        self.nsteps = int(nsteps)
+        self.precip_positive = bool(precip_positive)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            nlayers = int(f['nlayers'])
+            return cls([f[f'weight_{k}'] for k in range(nlayers)],
+                       [f[f'bias_{k}'] for k in range(nlayers)],
+                       list(f['inputs']), f['h'], f['nsteps'],
+                       f['precip_positive'])
+
+    def rhs(self, state, forcing, w):
+        """Source terms of a packed state
+
+        Parameters
+        ----------
+        state : (batch, 2 * nz)
+            packed as ``[sl, qt]``
+        forcing : dict
+            the forcing fields 'sl', 'qt', 'SHF', 'LHF', and 'SOLIN'
+        w : (nz,)
+            layer mass
+
+        Returns
+        -------
+        src : (batch, 2 * nz)
+        """
+        nz = state.shape[-1] // 2
+        inputs = {'prognostic': {'sl': state[..., :nz],
+                                 'qt': state[..., nz:]},
+                  'forcing': forcing}
+        x = np.concatenate([inputs[group][key] for group, key in self.inputs],
+                           -1)
+
+        for k, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            x = x @ weight + bias
+            if k < len(self.weights) - 1:
+                np.maximum(x, 0, out=x)
+
+        if self.precip_positive:
+            x[..., nz:] = enforce_precip_qt(x[..., nz:], forcing['LHF'], w)
+        return x
+
+    def step(self, state, forcing, w):
+        """Advance a packed state by one time step"""
+        nz = state.shape[-1] // 2
+        dt = self.h / self.nsteps
+        for j in range(self.nsteps):
+            state = state + dt * self.rhs(state, forcing, w)
+            state[..., nz:] = fix_moisture(state[..., nz:], w)
+        return state
+
+    def __call__(self, data):
+        """Run the model like `lib.torch.ForcedStepper`
+
+        Parameters
+        ----------
+        data : dict
+            the 'prognostic' and 'forcing' fields with shape (time, batch, n)
+            and the layer mass 'w' in 'constant'
+
+        Returns
+        -------
+        dict
+            ``data`` with the predicted 'prognostic' variables and the
+            'diagnostic' variables computed from the predicted states
+        """
+        prog = data['prognostic']
+        w = np.asarray(data['constant']['w'], dtype=np.float32)
+        nt = prog['sl'].shape[0]
+
+        state = np.concatenate((prog['sl'][0], prog['qt'][0]), -1)
+        steps = np.empty((nt,) + state.shape, dtype=state.dtype)
+        steps[0] = state
+        for i in range(1, nt):
+            forcing = {key: val[i - 1] for key, val in data['forcing'].items()}
+            state = self.step(state, forcing, w)
+            steps[i] = state
+
+        nz = state.shape[-1] // 2
+        sl, qt = steps[..., :nz], steps[..., nz:]
+
+        y = dict(data)
+        y['prognostic'] = {'sl': sl, 'qt': qt}
+        y['diagnostic'] = diagnostics(sl, qt, w, self.h)
+        return y
+
+
+def diagnostics(sl, qt, w, h):
+    """Budget diagnostics computed from a time series of states
+
+    See `lib.torch.model.compute_diagnostics`. The large-scale forcing is not
+    applied by the time stepper, so its contributions are zero.
+    """
+    s = mass_integrate(sl, w)
+    q = mass_integrate(qt, w)
+    zero = np.zeros_like(q[1:])
+    return {
+        'QLSF': zero,
+        'QNN': (q[1:] - q[:-1]) / h / 86400 / 1000**2,
+        'SLSF': zero,
+        'SNN': _cp * (s[1:] - s[:-1]) / h / 86400,
+    }
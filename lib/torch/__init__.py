@@ -2,3 +2,4 @@ from .training import train_multistep_objective
 from .interface import wrap, column_run
 from .model import ForcedStepper
 from .data import TrainingData
+from .inference import optimize_for_inference, export_numpy
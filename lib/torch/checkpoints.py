@@ -0,0 +1,283 @@
+"""Resumable checkpoints of the full training state
+
+A `Checkpointer` saves the state of a model, its optimizer, the random number
+generators, and the position in the training loop. The state is copied in the
+training thread, and then written to disk by a background thread, so that
+training only pauses for as long as it takes to copy the weights. Every file
+is first written to a temporary name and then renamed, so that a checkpoint
+is either complete or absent, even if the job is killed while writing it.
+
+Examples
+--------
+>>> checkpointer = Checkpointer("output/checkpoints",
+...                             {'model': model, 'optimizer': optimizer},
+...                             interval=500)
+>>> train(..., checkpointer=checkpointer)
+>>> checkpointer.close()
+"""
+import copy
+import glob
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+logger = logging.getLogger(__name__)
+
+_pattern = re.compile(r'checkpoint\.(\d+)\.(\d+)\.torch$')
+
+
+def snapshot(state):
+    """Copy a (nested) state dict, moving any tensors to the CPU"""
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    elif isinstance(state, dict):
+        return type(state)((key, snapshot(val)) for key, val in state.items())
+    elif isinstance(state, (list, tuple)):
+        return type(state)(snapshot(val) for val in state)
+    else:
+        return copy.deepcopy(state)
+
+
+def rng_state():
+    """Return the state of the python, numpy, and torch random generators"""
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """Restore the random generators from `rng_state`"""
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def atomic_save(obj, path):
+    """Save with `torch.save` to a temporary file, and then rename it"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    torch.save(obj, tmp)
+    os.replace(tmp, path)
+
+
+class Checkpointer(object):
+    """Save and restore the training state in the background
+
+    Parameters
+    ----------
+    directory : str
+        where the checkpoints are saved as ``checkpoint.{epoch}.{batch}.torch``
+    objects : dict
+        the objects to save. These have ``state_dict`` and ``load_state_dict``
+        methods, like modules and optimizers, or are lists, like the history
+        of the losses, which are restored in place.
+    interval : int
+        number of training batches between checkpoints
+    keep : int
+        number of checkpoints kept on disk. Older checkpoints are removed
+        once a newer one is written.
+    enabled : bool
+        if False, no files are written, but the checkpoints can still be
+        restored. This is used by all but one process of distributed training.
+    metadata : dict, optional
+        JSON serializable description of the run, e.g. its arguments. This is
+        saved with every checkpoint, and only checkpoints with equal metadata
+        are restored, so that a run with other settings starts over.
+    """
+
+    def __init__(self, directory, objects, interval=500, keep=2, enabled=True,
+                 metadata=None):
+        self.directory = directory
+        self.objects = objects
+        self.interval = interval
+        self.keep = keep
+        self.enabled = enabled
+        # compare the metadata as it is loaded back from JSON
+        self.metadata = json.loads(json.dumps(metadata))
+
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = None
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                obj, path = item
+                atomic_save(obj, path)
+                logger.debug(f"Saved {path}")
+                if _pattern.search(path):
+                    self._remove_old()
+            except Exception as e:
+                logger.error(f"Failed to write a checkpoint: {e}")
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write(self, obj, path):
+        """Save ``obj`` to ``path`` in the background
+
+        ``obj`` must not be modified afterwards, so pass a `snapshot` of any
+        state which is still being trained. This blocks while an earlier
+        object is waiting to be written, so at most two copies of the state
+        are held in memory.
+        """
+        self._check()
+        if not self.enabled:
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._write, daemon=True)
+            self._thread.start()
+        self._queue.put((obj, path))
+
+    def save(self, progress):
+        """Save a snapshot of the objects and random generators
+
+        Parameters
+        ----------
+        progress : dict
+            the position in the training loop. It must have the 'epoch' and
+            'batch' keys, where 'batch' is the number of batches of the epoch
+            which are done.
+        """
+        if not self.enabled:
+            return
+        state = {key: (snapshot(obj.state_dict())
+                       if hasattr(obj, 'state_dict') else snapshot(obj))
+                 for key, obj in self.objects.items()}
+        checkpoint = {'objects': state, 'rng': rng_state(),
+                      'metadata': self.metadata}
+        checkpoint.update(snapshot(progress))
+        path = os.path.join(
+            self.directory,
+            f"checkpoint.{progress['epoch']}.{progress['batch']}.torch")
+        self.write(checkpoint, path)
+
+    def paths(self):
+        """Return the checkpoint files, newest first"""
+        found = []
+        for path in glob.glob(os.path.join(self.directory, '*.torch')):
+            match = _pattern.search(path)
+            if match:
+                found.append((tuple(map(int, match.groups())), path))
+        return [path for _, path in sorted(found, reverse=True)]
+
+    def _remove_old(self):
+        for path in self.paths()[self.keep:]:
+            os.remove(path)
+
+    def _find(self):
+        for path in self.paths():
+            try:
+                checkpoint = torch.load(path, map_location='cpu',
+                                        weights_only=False)
+            except Exception as e:
+                logger.warning(f"Skipping the unreadable checkpoint {path}: "
+                               f"{e}")
+                continue
+            if checkpoint.get('metadata') != self.metadata:
+                logger.warning(f"Skipping the checkpoint {path} of a run "
+                               f"with other arguments")
+                continue
+            return path, checkpoint
+        return None, None
+
+    def latest(self):
+        """Load the newest checkpoint which can be read and has the same
+        metadata
+
+        In distributed training, rank 0 chooses the checkpoint, and the other
+        processes load the same file, so that every process resumes from the
+        same batch. This must be called by every process.
+
+        Returns
+        -------
+        checkpoint : dict or None
+            None if there is no such checkpoint
+        """
+        if not _distributed():
+            return self._find()[1]
+
+        choice = [None]
+        if dist.get_rank() == 0:
+            path, checkpoint = self._find()
+            if checkpoint is not None:
+                choice = [(checkpoint['epoch'], checkpoint['batch'], path)]
+        dist.broadcast_object_list(choice, src=0)
+        if choice[0] is None:
+            return None
+
+        epoch, batch, path = choice[0]
+        if dist.get_rank() != 0:
+            checkpoint = torch.load(path, map_location='cpu',
+                                    weights_only=False)
+            if (checkpoint['epoch'], checkpoint['batch']) != (epoch, batch):
+                raise RuntimeError(f"{path} is not the checkpoint of epoch "
+                                   f"{epoch} and batch {batch} chosen by "
+                                   f"rank 0")
+        return checkpoint
+
+    def restore(self, checkpoint):
+        """Load a checkpoint from `latest` into the objects
+
+        The random generators are not restored, see `set_rng_state`.
+        """
+        for key, obj in self.objects.items():
+            state = checkpoint['objects'][key]
+            if hasattr(obj, 'load_state_dict'):
+                obj.load_state_dict(state)
+            else:
+                obj[:] = state
+
+    def wait(self):
+        """Block until every checkpoint has been written"""
+        if self._thread is not None:
+            self._queue.join()
+        self._check()
+
+    def clear(self):
+        """Wait for the pending writes, and then remove every checkpoint
+
+        In distributed training, this must be called by every process, and
+        the files are only removed once all of them are done.
+        """
+        self.wait()
+        if _distributed():
+            dist.barrier()
+        if self.enabled:
+            for path in self.paths():
+                os.remove(path)
+
+    def close(self):
+        """Write the remaining checkpoints and stop the background thread"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._check()
@@ -0,0 +1,160 @@
+"""TorchScript versions of the time stepping model
+
+The modules in this module operate on packed tensors instead of dicts, so
+that the whole time stepping loop can be compiled with `torch.jit.script`.
+They share their parameters with the `ForcedStepper` they are created from,
+so they can be used for both training and inference.
+"""
+import torch
+from torch import nn, Tensor
+
+
+def precip_constraint(fqt: Tensor, lhf: Tensor, w: Tensor) -> Tensor:
+    """Tensor-only version of `lib.torch.model.enforce_precip_qt`"""
+    evap = lhf * 86400 / 2.51e6
+    val_x = -(fqt * w).sum(-1, keepdim=True) / 1000.
+    val_v = -w.sum() / 1000.
+    alpha = (val_x + evap).clamp(max=0)
+    return fqt - alpha / val_v
+
+
+def fix_moisture(q: Tensor, w: Tensor, eps: float = 1e-9) -> Tensor:
+    """Tensor-only version of `lib.torch.model._fix_moisture`"""
+    cond = (q < eps).float()
+    total_moisture = (q * w).sum(-1, keepdim=True)
+    moisture_lack = (cond * w).sum(-1, keepdim=True) * eps
+    moisture_valid = ((1 - cond) * q * w).sum(-1, keepdim=True)
+    alpha = (total_moisture - moisture_lack) / moisture_valid
+    return cond * eps + (1 - cond) * q * alpha
+
+
+def _scaler_vectors(scaler, keys, sizes):
+    """Means and scales of the scaler for packed variables"""
+    scales, means = scaler.args
+    mean, scale = [], []
+    for key, n in zip(keys, sizes):
+        if key in scales and key in means:
+            mean.append(means[key].float().expand(n))
+            scale.append(scales[key].float().expand(n) + 1e-7)
+        else:
+            mean.append(torch.zeros(n))
+            scale.append(torch.ones(n))
+    return torch.cat(mean), torch.cat(scale)
+
+
+class ScriptedRHS(nn.Module):
+    """Scriptable `RHS` operating on packed tensors
+
+    The prognostic state is packed as ``[sl, qt]`` and the forcing as
+    ``[SHF, LHF, SOLIN, sl, qt]``, along the last dimension.
+    """
+
+    def __init__(self, rhs):
+        super(ScriptedRHS, self).__init__()
+        nz = rhs.lin.out_features // 2
+        self.nz = nz
+        self.precip_positive = bool(rhs.precip_positive)
+        self.mlp = rhs.mlp
+        self.bn = rhs.bn
+
+        mean, scale = _scaler_vectors(rhs.scaler, ['sl', 'qt'], [nz, nz])
+        self.register_buffer('prog_mean', mean)
+        self.register_buffer('prog_scale', scale)
+
+        mean, scale = _scaler_vectors(
+            rhs.scaler, ['SHF', 'LHF', 'SOLIN', 'sl', 'qt'],
+            [1, 1, 1, nz, nz])
+        self.register_buffer('forcing_mean', mean)
+        self.register_buffer('forcing_scale', scale)
+
+    def forward(self, x: Tensor, f: Tensor, w: Tensor) -> Tensor:
+        xs = (x - self.prog_mean) / self.prog_scale
+        fs = self.bn((f - self.forcing_mean) / self.forcing_scale)
+        y = self.mlp(torch.cat((xs, fs), -1))
+
+        if self.precip_positive:
+            nz = self.nz
+            fqt = precip_constraint(y[:, nz:], f[:, 1:2], w)
+            y = torch.cat((y[:, :nz], fqt), -1)
+
+        return y
+
+
+class ScriptedStepper(nn.Module):
+    """Scriptable `ForcedStepper` operating on packed tensors"""
+
+    def __init__(self, stepper):
+        super(ScriptedStepper, self).__init__()
+        self.rhs = ScriptedRHS(stepper.rhs)
+        self.h = float(stepper.h)
+        self.nsteps = int(stepper.nsteps)
+        self.nz = self.rhs.nz
+
+    def forward(self, prog: Tensor, forcing: Tensor, w: Tensor) -> Tensor:
+        """
+        Parameters
+        ----------
+        prog : (batch, 2 * nz)
+            initial state
+        forcing : (time, batch, nf)
+            packed forcing
+        w : (nz,)
+            layer mass
+
+        Returns
+        -------
+        prog : (time, batch, 2 * nz)
+        """
+        nz = self.nz
+        dt = self.h / self.nsteps
+        steps = [prog]
+        for i in range(1, forcing.size(0)):
+            f = forcing[i - 1]
+            for j in range(self.nsteps):
+                prog = prog + dt * self.rhs(prog, f, w)
+                qt = fix_moisture(prog[:, nz:], w)
+                prog = torch.cat((prog[:, :nz], qt), -1)
+            steps.append(prog)
+        return torch.stack(steps)
+
+
+class CompiledStepper(nn.Module):
+    """Drop-in replacement for `ForcedStepper` with a compiled time loop
+
+    The diagnostics of `ForcedStepper` are not computed, and only the
+    forward Euler integrator is supported. The backward pass cannot be
+    checkpointed or truncated.
+
+    Examples
+    --------
+    >>> fast = CompiledStepper(stepper)
+    >>> y = fast(batch)
+    """
+    forcing_keys = ('SHF', 'LHF', 'SOLIN', 'sl', 'qt')
+
+    def __init__(self, stepper):
+        super(CompiledStepper, self).__init__()
+        if getattr(stepper, 'method', 'euler') != 'euler':
+            raise ValueError("CompiledStepper only supports the 'euler' "
+                             "integrator")
+        if getattr(stepper, 'checkpoint', None) or \
+                getattr(stepper, 'truncate', None):
+            raise ValueError("CompiledStepper does not support checkpointing "
+                             "or truncating the backward pass")
+        self.stepper = torch.jit.script(ScriptedStepper(stepper))
+        self.forcing_names = stepper.forcing_names
+        self.nz = stepper.rhs.lin.out_features // 2
+
+    def forward(self, data: dict):
+        prog = data['prognostic']
+        forcing = data['forcing']
+        w = data['constant']['w']
+
+        prog0 = torch.cat((prog['sl'][0], prog['qt'][0]), -1)
+        forcing = torch.cat([forcing[key] for key in self.forcing_keys], -1)
+        out = self.stepper(prog0, forcing, w)
+
+        y = data.copy()
+        y['prognostic'] = {'sl': out[..., :self.nz], 'qt': out[..., self.nz:]}
+        y['diagnostic'] = {}
+        return y
@@ -35,3 +35,86 @@ def apply_linear_constraint(lin, a, x, *args, inequality=False, v=None,
         alpha = alpha.clamp(max=0)
 
     return x - v * (alpha/val_v)
+
+
+class LinearConstraints(nn.Module):
+    """Project onto several linear equality or inequality constraints
+
+    The constraints are ``A @ x = b`` or ``A @ x >= b`` row by row, where
+    ``b`` can differ for every sample. The input is adjusted along the rows
+    of ``V``, which defaults to ``A`` (orthogonal projection)::
+
+        x - r @ M.T,   M = V.T @ inv(A @ V.T)
+
+    where ``r = A @ x - b`` and the positive residuals of the inequality
+    constraints are set to zero. ``M`` is computed once, so applying the
+    constraints costs two small matrix multiplies. If the inequality
+    constraints are coupled (``A @ V.T`` is not diagonal), the result only
+    satisfies the constraints which are active.
+
+    Parameters
+    ----------
+    A : (k, n)
+        the linear functionals
+    V : (k, n), optional
+        the directions used to adjust the input
+    inequality : bool or sequence of bools
+        which constraints are inequalities
+
+    Examples
+    --------
+    >>> A = torch.tensor([[1.0, 1.0, 1.0]])
+    >>> con = LinearConstraints(A, inequality=True)
+    >>> con(torch.tensor([[-1.0, 0.0, -2.0]]), torch.zeros(1, 1))
+    tensor([[ 0.,  1., -1.]])
+    """
+
+    def __init__(self, A, V=None, inequality=False):
+        super(LinearConstraints, self).__init__()
+        if V is None:
+            V = A
+        A64, V64 = A.double(), V.double()
+        M = V64.t() @ torch.inverse(A64 @ V64.t())
+
+        inequality = torch.as_tensor(inequality, dtype=torch.bool,
+                                     device=A.device)
+        self.register_buffer('A', A)
+        self.register_buffer('M', M.to(A.dtype))
+        self.register_buffer('inequality', inequality.expand(A.size(0)))
+
+    def residual(self, x, b):
+        """Violation of the constraints"""
+        r = x @ self.A.t() - b
+        return torch.where(self.inequality, r.clamp(max=0), r)
+
+    def forward(self, x, b):
+        return x - self.residual(x, b) @ self.M.t()
+
+
+class ConstraintCache(object):
+    """Build a constraint again only when the tensor it depends on changes
+
+    This is used for constraints which depend on the layer mass, which is
+    passed with every batch but rarely changes.
+    """
+
+    def __init__(self, build):
+        self.build = build
+        self._key = None
+        self._value = None
+
+    def _is_cached(self, w):
+        key = self._key
+        if key is None:
+            return False
+        w_key, version = key
+        if w is w_key:
+            return w._version == version
+        return (w.shape == w_key.shape and w.device == w_key.device and
+                torch.equal(w, w_key))
+
+    def __call__(self, w):
+        if not self._is_cached(w):
+            self._key = (w, w._version)
+            self._value = self.build(w)
+        return self._value
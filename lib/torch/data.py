@@ -22,72 +22,115 @@ See Also
 lib.data.prepare_data
 
 """
+import json
 import logging
+import os
+from functools import partial
 
 import attr
+import dask
 import numpy as np
 import torch
-from toolz import valmap, curry
+from toolz import curry, dissoc, valmap
 from torch.utils.data import DataLoader
-from torch.utils.data.dataloader import default_collate
-from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data.distributed import DistributedSampler
+from torch.utils.data.sampler import (BatchSampler, RandomSampler,
+                                      SequentialSampler)
 
 import xarray as xr
 
 from ..thermo import layer_mass, liquid_water_temperature
-from .datasets import DictDataset, WindowedData
+from .datasets import (BlockWindowStream, DictDataset, QuantizedArray,
+                       WindowedData, WindowSampler, _load_block)
 from .loss import dynamic_loss
-from .normalization import scaler
+from .normalization import Moments, scaler
 
 logger = logging.getLogger(__name__)
 
+# forcing variables which are not required by every model
+auxiliary_names = ('QRAD', 'LHF', 'SHF', 'SOLIN')
 
+# attributes of TrainingData holding the forcing of the prognostic variables
+forcing_fields = {'sl': 'FSL', 'qt': 'FQT'}
 
-def _compute_weighted_scale(x, layer_mass):
-    sample_dims = tuple(range(x.ndim - 1))
-    sig2 = x.var(axis=sample_dims)
 
+
+def _save_statistics(path, moments):
+    """Cache the statistics of a dataset
+
+    The file is written to a temporary name and then renamed, so that other
+    processes opening the same dataset never read a partial file. The
+    statistics are only a cache, so a failure to write them, for instance to
+    a read-only directory, is not an error.
+    """
+    logger.debug(f"Saving statistics to {path}")
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'wb') as f:
+            np.savez(f, **{
+                f"{key}_{name}": getattr(m, name)
+                for key, m in moments.items()
+                for name in ['count', 'mean', 'm2']
+            })
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning(f"Could not save the statistics to {path}: {e}")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _compute_weighted_scale(sig2, layer_mass):
     assert sig2.shape == layer_mass.shape
 
     avg_sig2 = (sig2 * layer_mass / layer_mass.sum()).sum()
     return np.sqrt(avg_sig2)
 
 
-def _loss_weight(x, layer_mass):
-    """Compute MSE loss weight for numpy array
+def _loss_weight(sig2, layer_mass):
+    """Compute MSE loss weight from the variance of a field
 
     Parameters
     ----------
-    x : (..., z)
+    sig2 : (z, )
+        variance of the field at each height
     layer_mass : (z, )
     """
-    scale = _compute_weighted_scale(x, layer_mass)
+    scale = _compute_weighted_scale(sig2, layer_mass)
     return layer_mass / scale**2
 
 
-def prepare_array(x):
+def _hashable(x):
+    if isinstance(x, (list, tuple, np.ndarray)):
+        return tuple(np.ravel(x).tolist())
+    return x
+
+
+def _isel(x, indexers):
+    """Apply the indexers for the dimensions of x"""
+    return x.isel(**{dim: val for dim, val in indexers.items()
+                     if dim in x.dims})
+
+
+def prepare_array(x, lazy=False):
     output_dims = [dim for dim in ['time', 'y', 'x', 'z'] if dim in x.dims]
-    return x.transpose(*output_dims).values.astype(np.float32)
+    x = x.transpose(*output_dims)
+    if lazy and 'time' in x.dims and x.ndim > 1:
+        return x.data.astype(np.float32)
+    return x.values.astype(np.float32)
 
 
 @curry
-def collate_fn(constants, seq):
-    collated = default_collate(seq)
-    d = _transpose_vars(collated)
+def collate_fn(constants, batch):
+    """Add the constants to a batch gathered by `DictDataset`
+
+    The windows are already collated into (window, batch, z) tensors, so no
+    copying or transposing is needed here.
+    """
+    d = dict(batch)
     d['constant'] = constants
     return d
 
 
-def _transpose_vars(data):
-    if torch.is_tensor(data):
-        return data.transpose(0, 1)
-    elif isinstance(data, dict):
-        return {
-            key: _transpose_vars(val)
-            for key, val in data.items()
-        }
-
-
 @attr.s
 class TrainingData(object):
     qt = attr.ib()
@@ -119,27 +162,70 @@ class TrainingData(object):
 
     def forcing(self):
         # create forcing dictionary
-        auxiliary_names = ('QRAD', 'LHF', 'SHF', 'SOLIN', 'y')
         forcing_variables = {
             'sl': self.FSL,
             'qt': self.FQT,
         }
-        for name in auxiliary_names:
+        for name in auxiliary_names + ('y',):
             forcing_variables[name] = getattr(self, name)
 
         return forcing_variables
 
+    def statistics(self, chunk_size=10):
+        """Mean and variance of the prognostic variables at each height
+
+        The statistics are computed in a single pass over chunks of
+        ``chunk_size`` times, so the data are never fully loaded into memory.
+        The result is cached, and for datasets opened by `from_memmap` it is
+        also saved as ``statistics.npz`` in the dataset directory.
+
+        Returns
+        -------
+        moments : dict
+            `Moments` of 'qt' and 'sl'
+        """
+        if getattr(self, '_statistics', None) is not None:
+            return self._statistics
+
+        cache_dir = getattr(self, '_cache_dir', None)
+        cache = cache_dir and os.path.join(cache_dir, 'statistics.npz')
+
+        moments = None
+        if cache and os.path.exists(cache):
+            logger.debug(f"Loading statistics from {cache}")
+            try:
+                with np.load(cache) as f:
+                    moments = {
+                        key: Moments(f[key + '_count'], f[key + '_mean'],
+                                     f[key + '_m2'])
+                        for key in ['qt', 'sl']
+                    }
+            except Exception as e:
+                logger.warning(f"Ignoring unreadable statistics {cache}: {e}")
+
+        if moments is None:
+            fields = {'stats': self.prognostic()}
+            moments = {key: Moments() for key in fields['stats']}
+            for start in range(0, self.qt.shape[0], chunk_size):
+                block = _load_block(fields, start, start + chunk_size)
+                for key, x in block['stats'].items():
+                    moments[key] = moments[key] + Moments.from_array(x)
+
+            if cache:
+                _save_statistics(cache, moments)
+
+        self._statistics = moments
+        return moments
+
     def scaler(self):
         # compute mean and stddev
         # this is an error, std does not work like this
         means = {}
         scales = {}
-        input_vars = {'qt': self.qt, 'sl': self.sl}
 
-        for key, X in input_vars.items():
-            m = X.shape[-1]
-            mu = X.reshape((-1, m)).mean(axis=0)
-            sig = X.reshape((-1, m)).std(axis=0)
+        for key, moments in self.statistics().items():
+            mu = moments.mean.astype(np.float32)
+            sig = moments.std.astype(np.float32)
 
             # convert to torch
             mu, sig = [torch.from_numpy(np.squeeze(x)) for x in [mu, sig]]
@@ -154,8 +240,8 @@ class TrainingData(object):
 
     def dynamic_loss(self, **kwargs):
         weights = {
-            'qt': _loss_weight(self.qt, self.layer_mass),
-            'sl': _loss_weight(self.sl, self.layer_mass),
+            key: _loss_weight(moments.var, self.layer_mass).astype(np.float32)
+            for key, moments in self.statistics().items()
         }
         weights = valmap(torch.from_numpy, weights)
         return dynamic_loss(weights=weights, **kwargs)
@@ -163,83 +249,282 @@ class TrainingData(object):
     def get_num_features(self):
         return len(self.p) * 2
 
-    def torch_dataset(self, window_size):
+    @property
+    def is_lazy(self):
+        """True if the fields are lazy (e.g. dask) arrays"""
+        return not isinstance(self.qt, (np.ndarray, QuantizedArray))
+
+    def compact(self, storage='float16'):
+        """Return a copy which stores the windowed fields more compactly
+
+        The fields are converted back to float32 when batches are gathered by
+        `get_loader`.
 
+        Parameters
+        ----------
+        storage : str
+            'float16' or 'int16'. With 'int16', each vertical level is
+            quantized using its own scale and offset (see `QuantizedArray`).
+        """
+        if storage == 'float16':
+            convert = partial(np.asarray, dtype=np.float16)
+        elif storage == 'int16':
+            convert = QuantizedArray.from_array
+        else:
+            raise ValueError(f"Unknown storage type: {storage}")
+
+        variables = self._windowed_variables()
+        fields = {forcing_fields.get(key, key): val
+                  for key, val in variables['forcing'].items()}
+        fields.update(variables['prognostic'])
+        return attr.evolve(self, **valmap(convert, fields))
+
+    def isel(self, **indexers):
+        """Return a copy with integer selections along 'time', 'y', or 'x'
+
+        Examples
+        --------
+        >>> region = data.isel(y=[0, 1, 2, 48, 49])
+        """
+        axes = {'time': 0, 'y': 1, 'x': 2}
+        unknown = set(indexers) - set(axes)
+        if unknown:
+            raise ValueError(f"Cannot select along {unknown}")
+
+        def select(val):
+            for dim, ind in indexers.items():
+                index = (slice(None),) * axes[dim] + (ind,)
+                val = val[index]
+            return val
+
+        fields = {}
+        for key, val in attr.asdict(self, recurse=False).items():
+            if key in axes:
+                val = np.asarray(val)[indexers.get(key, slice(None))]
+            elif isinstance(val, QuantizedArray):
+                val = attr.evolve(val, data=select(val.data))
+            elif val is not None and np.ndim(val) > 2:
+                val = select(val)
+            fields[key] = val
+        return attr.evolve(self, **fields)
+
+    def num_windows(self, window_size):
+        nt, ny, nx = self.qt.shape[:3]
+        return (nt - window_size + 1) * ny * nx
+
+    def _windowed_variables(self, forcing_names=None):
+        """Prognostic and forcing variables which are windowed for training
+
+        Parameters
+        ----------
+        forcing_names : sequence of str, optional
+            the forcing variables to include. By default all the forcing
+            variables which were loaded are included.
+        """
         # create prognostic dict
         prognostic_variables = {'sl': self.sl, 'qt': self.qt}
 
         # create forcing dictionary
-        auxiliary_names = ('QRAD', 'LHF', 'SHF', 'SOLIN')
-        forcing_variables = {
-            'sl': self.FSL,
-            'qt': self.FQT,
-        }
-        for name in auxiliary_names:
-            forcing_variables[name] = getattr(self, name)
-
+        if forcing_names is None:
+            forcing_names = ('sl', 'qt') + tuple(
+                name for name in auxiliary_names
+                if getattr(self, name) is not None)
+
+        forcing_variables = {}
+        for name in forcing_names:
+            val = getattr(self, forcing_fields.get(name, name))
+            if val is None:
+                raise ValueError(f"Forcing variable {name} was not loaded")
+            forcing_variables[name] = val
+
+        return {'prognostic': prognostic_variables,
+                'forcing': forcing_variables}
+
+    def torch_dataset(self, window_size, forcing_names=None):
         # turn these into windowed datasets
-        X = DictDataset({
-            key: WindowedData(val, window_size)
-            for key, val in prognostic_variables.items()
-        })
-        G = DictDataset({
-            key: WindowedData(val, window_size)
-            for key, val in forcing_variables.items()
+        variables = self._windowed_variables(forcing_names)
+        return DictDataset({
+            group: DictDataset({
+                key: WindowedData(val, window_size)
+                for key, val in variables[group].items()
+            })
+            for group in variables
         })
 
-        return DictDataset({'prognostic': X, 'forcing': G})
+    def stream(self, window_size, batch_size, num_samples=None, shuffle=True,
+               forcing_names=None, **kwargs):
+        """Stream batches of windows without loading the full dataset
+
+        Parameters
+        ----------
+        **kwargs
+            passed to `BlockWindowStream`
+
+        See Also
+        --------
+        BlockWindowStream
+        """
+        return BlockWindowStream(self._windowed_variables(forcing_names),
+                                 window_size, batch_size,
+                                 num_samples=num_samples, shuffle=shuffle,
+                                 **kwargs)
 
     def get_loader(self, window_size, num_samples=None, batch_size=None,
-                   **kwargs):
+                   forcing_names=None, y_weights=None, seed=None, rank=0,
+                   num_replicas=1, **kwargs):
         """Return the whole dataset as a batch for input to ForcedStepper
 
+        Only the forcing variables in ``forcing_names`` are windowed and
+        collated. See `ForcedStepper.forcing_names`.
+
+        Parameters
+        ----------
+        window_size : int
+        num_samples : int, optional
+            if given, sample this many windows with replacement using a
+            `WindowSampler`. Otherwise, the full dataset is used.
+        batch_size : int, optional
+        forcing_names : sequence of str, optional
+        y_weights : array_like, optional
+            relative sampling probability of each y row. Implies sampling
+            with a `WindowSampler`. This is not supported for lazy data.
+        seed : int, optional
+            seed of the random sampler
+        rank, num_replicas : int
+            for distributed training, split every batch between
+            ``num_replicas`` processes and only load the part of process
+            ``rank``. The processes must use the same seed. This is not
+            supported for lazy data.
+
         Yields
         -------
         batch : dict
             contains keys 'constant', 'prognostic', 'forcing'.
 
+        Notes
+        -----
+        If the data are lazy (see `from_files`), the batches are streamed from
+        blocks of time using `stream`. The keyword arguments ``block_size``
+        and ``buffer_blocks`` are then passed to `BlockWindowStream`.
         """
-        dataset = self.torch_dataset(window_size)
-
+        constants = valmap(torch.from_numpy, self.constants())
+        shuffle = kwargs.pop('shuffle', False)
+
+        if self.is_lazy:
+            if num_replicas > 1:
+                raise ValueError("Lazy data cannot be loaded in parallel by "
+                                 "several processes")
+            if y_weights is not None:
+                raise ValueError("Lazy data cannot be sampled with y_weights")
+            if kwargs.get('num_workers', 0) > 0:
+                # every worker would replay the whole stream
+                raise ValueError("Lazy data cannot be loaded by worker "
+                                 "processes. Use prefetching instead.")
+            logger.info("Streaming batches from lazy training data")
+            stream_kwargs = {key: kwargs.pop(key) for key in
+                             ['block_size', 'buffer_blocks']
+                             if key in kwargs}
+            dataset = self.stream(
+                window_size, batch_size or self.num_windows(window_size),
+                num_samples=num_samples, shuffle=shuffle,
+                forcing_names=forcing_names, seed=seed, **stream_kwargs)
+            return DataLoader(dataset, batch_size=None,
+                              collate_fn=collate_fn(constants), **kwargs)
+
+        dataset = self.torch_dataset(window_size, forcing_names)
 
         # Create training data loaders
-        if num_samples:
+        if num_samples or y_weights is not None:
+            num_samples = num_samples or len(dataset)
             logger.info(f"Using boostrap sample of {num_samples}.")
-            inds = np.random.choice(len(dataset), num_samples,
-                                    replace=False)
-            kwargs['sampler'] = SubsetRandomSampler(inds)
+            nt, ny, nx = self.qt.shape[:3]
+            sampler = WindowSampler(
+                nt - window_size + 1, ny, nx, num_samples,
+                batch_size or num_samples, weights=y_weights, seed=seed,
+                rank=rank, num_replicas=num_replicas)
         else:
             logger.info(f"Using full training dataset")
             num_samples = len(dataset)
+            batch_size = batch_size or num_samples
+            if num_replicas > 1:
+                sampler = DistributedSampler(
+                    dataset, num_replicas=num_replicas, rank=rank,
+                    shuffle=shuffle, seed=seed or 0)
+                batch_size = -(-batch_size // num_replicas)
+            elif shuffle:
+                sampler = RandomSampler(dataset)
+            else:
+                sampler = SequentialSampler(dataset)
+
+            # the dataset gathers whole batches at once
+            sampler = BatchSampler(sampler, batch_size, drop_last=False)
+
+        # automatic batching is disabled because the sampler yields batches
+        return DataLoader(dataset, sampler=sampler, batch_size=None,
+                          collate_fn=collate_fn(constants), **kwargs)
+
+
+    def cached_loader(self, window_size, **kwargs):
+        """Return a loader from `get_loader`, reusing it for repeated arguments
+
+        The dataset, sampler, and any persistent worker processes of a loader
+        are kept alive and reused whenever the same window size and sampling
+        configuration is requested again, e.g. in later epochs.
+        """
+        key = (window_size,) + tuple(
+            (name, _hashable(val)) for name, val in sorted(kwargs.items()))
 
-        if batch_size:
-            kwargs['batch_size'] = batch_size
-        else:
-            kwargs['batch_size'] = num_samples
-
-        constants = valmap(torch.from_numpy, self.constants())
-        return DataLoader(dataset, collate_fn=collate_fn(constants),
-                          **kwargs)
+        if not hasattr(self, '_loaders'):
+            self._loaders = {}
 
+        if key not in self._loaders:
+            self._loaders[key] = self.get_loader(window_size, **kwargs)
+        return self._loaders[key]
 
-    def from_files(paths, post=None):
+    def from_files(paths, post=None, lazy=False, isel=None, splits=None):
         """Create TrainingData from filenames
 
+        Parameters
+        ----------
+        paths : dict
+            mapping from variable name to netCDF file
+        post : callable, optional
+            function applied to every variable before it is loaded
+        lazy : bool
+            if True, the time-dependent fields are kept as dask arrays and are
+            only read block by block when streamed by `get_loader`.
+        isel : dict, optional
+            integer selection, e.g. ``{'y': slice(26, 38)}``, applied to every
+            variable as soon as it is opened, so that only the selected data
+            are read from disk.
+        splits : dict, optional
+            mapping from a split name to a further selection. If given, a
+            dict of TrainingData objects is returned, one for each split. All
+            the splits are read from the files at once.
+
         Examples
         --------
         >>> TrainingData.from_files(default='all.nc', p='p.nc')
+        >>> TrainingData.from_files(paths, splits={'train': {'x': slice(64, None)},
+        ...                                        'test': {'x': slice(0, 64)}})
         """
+        isel = isel or {}
+
+        # open each file only once
+        datasets = {}
+        for path in set(paths.values()):
+            logger.debug(f"Loading {path}")
+            datasets[path] = xr.open_dataset(path, chunks={'time': 10})
+
         init_kwargs = {}
-        for key in paths:
-            logger.debug(f"Loading {paths[key]}")
-            init_kwargs[key] = xr.open_dataset(
-                paths[key], chunks={
-                    'time': 10
-                })[key]
+        for key, path in paths.items():
+            init_kwargs[key] = _isel(datasets[path][key], isel)
 
         # compute layer mass from stat file
         if 'RHO' in paths:
-            rho = init_kwargs.pop('RHO')[0]
+            rho = _isel(datasets[paths['RHO']]['RHO'],
+                        dissoc(isel, 'time'))[0]
+            init_kwargs.pop('RHO')
             rhodz = layer_mass(rho)
 
             init_kwargs['layer_mass'] = rhodz
@@ -261,38 +546,173 @@ class TrainingData(object):
         if post:
             init_kwargs = valmap(post, init_kwargs)
 
-        # add coordinate information
-        sl = init_kwargs['sl']
-        init_kwargs['x'] = sl.x
-        init_kwargs['y'] = sl.y
-        init_kwargs['time'] = sl.time
+        # the auxiliary forcings are optional
+        for key in auxiliary_names:
+            init_kwargs.setdefault(key, None)
+
+        split_kwargs = {}
+        for name, sel in (splits or {None: {}}).items():
+            kwargs = {key: None if x is None else _isel(x, sel)
+                      for key, x in init_kwargs.items()}
+
+            # add coordinate information
+            sl = kwargs['sl']
+            kwargs['x'] = sl.x
+            kwargs['y'] = sl.y
+            kwargs['time'] = sl.time
+
+            split_kwargs[name] = kwargs
+
+        # read the data for all the splits in one pass over the files
+        if not lazy:
+            split_kwargs, = dask.compute(split_kwargs)
 
         # process all files into numpy arrays
-        init_kwargs = {key: prepare_array(x) for key, x in init_kwargs.items()}
+        output = {
+            name: TrainingData(**{
+                key: None if x is None else prepare_array(x, lazy=lazy)
+                for key, x in kwargs.items()
+            })
+            for name, kwargs in split_kwargs.items()
+        }
+
+        if splits is None:
+            return output[None]
+        return output
 
+    @staticmethod
+    def required_variables(forcing_names):
+        """Variables which must be read from disk for the given forcings
 
-        return TrainingData(**init_kwargs)
+        Parameters
+        ----------
+        forcing_names : sequence of str
+            see `ForcedStepper.forcing_names`
+
+        Returns
+        -------
+        variables : set of str
+            names of the variables in the netCDF files
+        """
+        variables = {'p', 'RHO', 'TABS', 'QV', 'QN', 'QP'}
+        for name in forcing_names:
+            variables.add(forcing_fields.get(name, name))
+        return variables
 
     @classmethod
-    def from_var_files(cls, files, **kwargs):
+    def from_var_files(cls, files, variables=None, **kwargs):
+        """Create TrainingData from a list of (path, variables) pairs
+
+        Parameters
+        ----------
+        files : list of tuples
+        variables : set of str, optional
+            only load these variables. See `required_variables`.
+        **kwargs
+            passed to `from_files`
+        """
         paths = {}
-        for path, variables in files:
-            paths.update({key: path for key in variables})
+        for path, file_variables in files:
+            paths.update({key: path for key in file_variables
+                          if variables is None or key in variables})
 
         return cls.from_files(paths, **kwargs)
 
     def save(self, path):
-        torch.save(attr.asdict(self), path)
+        torch.save(attr.asdict(self, recurse=False), path)
 
     @classmethod
     def load(cls, path):
+        if os.path.isdir(path):
+            return cls.from_memmap(path)
         return cls(**torch.load(path))
 
+    def to_memmap(self, path):
+        """Save to a directory which can be opened by `from_memmap`
+
+        Every multidimensional field is written to a raw binary file
+        ``{name}.bin``. The one dimensional coordinates are stored in
+        ``coords.npz``, and the shape and dtype of the binary files in
+        ``header.json``. Any statistics cached for earlier data in the
+        directory are removed.
+        """
+        os.makedirs(path, exist_ok=True)
+        stale = os.path.join(path, 'statistics.npz')
+        if os.path.exists(stale):
+            os.remove(stale)
+
+        header = {}
+        coords = {}
+        for key, val in attr.asdict(self, recurse=False).items():
+            if val is None:
+                continue
+
+            quantized = isinstance(val, QuantizedArray)
+            if quantized:
+                coords[key + '_scale'] = val.scale
+                coords[key + '_offset'] = val.offset
+                val = val.data
+
+            val = np.asarray(val)
+            if val.ndim > 1:
+                logger.debug(f"Writing {key} to {path}")
+                np.ascontiguousarray(val).tofile(
+                    os.path.join(path, f"{key}.bin"))
+                header[key] = {'dtype': val.dtype.str, 'shape': val.shape,
+                               'quantized': quantized}
+            else:
+                coords[key] = val
+
+        np.savez(os.path.join(path, 'coords.npz'), **coords)
+        with open(os.path.join(path, 'header.json'), 'w') as f:
+            json.dump(header, f)
+
+    @classmethod
+    def from_memmap(cls, path, mode='c'):
+        """Open a dataset saved by `to_memmap` without reading it into memory
+
+        The fields are memory mapped, so the pages are loaded on demand and
+        shared between all the processes which open the same directory.
+
+        Parameters
+        ----------
+        path : str
+            directory written by `to_memmap`
+        mode : str
+            mode passed to `np.memmap`. The default of 'c' (copy-on-write)
+            never modifies the files on disk.
+        """
+        with open(os.path.join(path, 'header.json')) as f:
+            header = json.load(f)
+
+        with np.load(os.path.join(path, 'coords.npz')) as coords:
+            init_kwargs = dict(coords)
+
+        for key, info in header.items():
+            init_kwargs[key] = np.memmap(
+                os.path.join(path, f"{key}.bin"),
+                dtype=np.dtype(info['dtype']),
+                mode=mode,
+                shape=tuple(info['shape']))
+
+            if info.get('quantized', False):
+                init_kwargs[key] = QuantizedArray(
+                    init_kwargs[key], init_kwargs.pop(key + '_scale'),
+                    init_kwargs.pop(key + '_offset'))
+
+        for field in auxiliary_names:
+            init_kwargs.setdefault(field, None)
+
+        data = cls(**init_kwargs)
+        data._cache_dir = path
+        return data
+
     @property
     def nbytes(self):
         total = 0
-        for val in attr.astuple(self):
-            total += val.nbytes
+        for val in attr.astuple(self, recurse=False):
+            if val is not None:
+                total += val.nbytes
         return total
 
     @property
@@ -2,7 +2,9 @@
 """
 import attr
 import numpy as np
-from torch.utils.data import Dataset
+import torch
+from numpy.lib.stride_tricks import as_strided
+from torch.utils.data import Dataset, IterableDataset, Sampler
 
 
 class ConcatDataset(Dataset):
@@ -17,6 +19,11 @@ class ConcatDataset(Dataset):
 
 
 class DictDataset(Dataset):
+    """Dataset of dicts
+
+    Indexing with a sequence of indices returns a dict of batches if the
+    underlying datasets support it (e.g. `WindowedData`).
+    """
     def __init__(self, mapping):
         self.datasets = mapping
 
@@ -27,57 +34,448 @@ class DictDataset(Dataset):
         return min(len(d) for d in self.datasets.values())
 
 
+@attr.s
+class QuantizedArray(object):
+    """Array stored as int16 with a scale and offset
+
+    For arrays with four dimensions there is a separate scale and offset for
+    each element of the last (vertical) dimension. Indexing returns the
+    decoded float32 values.
+
+    Examples
+    --------
+    >>> x = np.random.rand(10, 2, 3, 4).astype(np.float32)
+    >>> q = QuantizedArray.from_array(x)
+    >>> q.nbytes < x.nbytes
+    True
+    >>> np.allclose(q[:], x, atol=1e-4)
+    True
+    """
+    data = attr.ib()
+    scale = attr.ib()
+    offset = attr.ib()
+
+    @classmethod
+    def from_array(cls, x):
+        x = np.asarray(x)
+        axis = tuple(range(x.ndim - 1)) if x.ndim == 4 else None
+        lo = x.min(axis=axis).astype(np.float32)
+        hi = x.max(axis=axis).astype(np.float32)
+
+        offset = (hi + lo) / 2
+        scale = np.maximum((hi - lo) / (2 * 32767), np.finfo(np.float32).tiny)
+        data = np.round((x - offset) / scale).astype(np.int16)
+        return cls(data, scale, offset)
+
+    def decode(self, x):
+        return x.astype(np.float32) * self.scale + self.offset
+
+    def __getitem__(self, ind):
+        return self.decode(self.data[ind])
+
+    def __array__(self, dtype=None, copy=None):
+        return self[...] if dtype is None else self[...].astype(dtype)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def ndim(self):
+        return self.data.ndim
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.scale.nbytes + self.offset.nbytes
+
+
+def _decode(x):
+    """Upcast reduced precision storage to float32"""
+    if x.dtype == np.float16:
+        return x.astype(np.float32)
+    return x
+
+
 @attr.s
 class WindowedData(Dataset):
     """Window data along first dimension
 
+    Integer indices return a single window as a numpy array. A sequence of
+    indices returns the batch of windows as a single ``(window, batch, z)``
+    tensor, which is gathered with one fancy-indexing operation over a
+    strided view of the data.
+
     Examples
     --------
     >>> arr = np.arange(10).reshape((10, 1, 1, 1))
     >>> d = WindowedData(arr)
-    >>> d[0:5][:,0,0]
+    >>> d[0][:,0]
     array([0, 1, 2])
-    >>> d[0:5][:,1,0]
+    >>> d[1][:,0]
     array([1, 2, 3])
-    >>> d[0:5][:,2,0]
-    array([2, 3, 4])
-    >>> d[0:5][:,3,0]
-    array([3, 4, 5])
+    >>> d[[0, 1, 2, 3]][:, 2, 0].tolist()
+    [2, 3, 4]
     """
     x = attr.ib()
     chunk_size = attr.ib(default=3)
 
-    @property
-    def nwindows(self):
-        t  = self.reshaped.shape[0]
-        return  t - self.chunk_size + 1
+    def __attrs_post_init__(self):
+        x = self.x
+        if isinstance(x, QuantizedArray):
+            self._decode = x.decode
+            x = x.data
+        else:
+            self._decode = _decode
 
-    @property
-    def reshaped(self):
-        sh  = self.x.shape
+        sh = x.shape
 
         nt = sh[0]
-        if self.x.ndim == 4:
+        if x.ndim == 4:
             nf = sh[-1]
-        elif self.x.ndim == 3:
+        elif x.ndim == 3:
             nf = 1
         else:
             raise ValueError("data has dimension less the 3. Maybe it is not a time series variable.")
-        return self.x.reshape((nt, -1, nf))
+        self._reshaped = x.reshape((nt, -1, nf))
+
+        # view with shape (chunk_size, nwindows, batch, z). Indexing the
+        # middle two dimensions with arrays returns contiguous windows.
+        t, b, z = self._reshaped.strides
+        self._windows = as_strided(
+            self._reshaped,
+            shape=(self.chunk_size, self.nwindows) + self._reshaped.shape[1:],
+            strides=(t, t, b, z),
+            writeable=False)
+
+    @property
+    def nwindows(self):
+        t = self._reshaped.shape[0]
+        return t - self.chunk_size + 1
+
+    @property
+    def reshaped(self):
+        return self._reshaped
 
     def __len__(self):
-        b = self.reshaped.shape[1]
+        b = self._reshaped.shape[1]
         return self.nwindows * b
 
-
     def __getitem__(self, ind):
         """i + j nt  = ind
 
         """
+        if not np.isscalar(ind):
+            return self.get_batch(ind)
+
         i = ind % self.nwindows
         j = (ind-i) // self.nwindows
 
-        return self.reshaped[i:i+self.chunk_size,j,:]
+        return self._decode(self._reshaped[i:i+self.chunk_size,j,:])
+
+    def get_batch(self, inds):
+        """Gather the windows for a sequence of indices
+
+        Data stored with reduced precision is converted to float32 after it
+        is gathered.
+
+        Returns
+        -------
+        batch : torch.Tensor
+            (chunk_size, len(inds), z) tensor
+        """
+        inds = np.asarray(inds)
+        i = inds % self.nwindows
+        j = inds // self.nwindows
+        return torch.from_numpy(self._decode(self._windows[:, i, j, :]))
 
     def __repr__(self):
         return "WindowedData()"
+
+
+def stratified_weights(strata):
+    """Sampling weights which give every stratum the same total weight
+
+    Parameters
+    ----------
+    strata : array_like
+        label of each y row, e.g. ``np.abs(lat) < 15``
+
+    Returns
+    -------
+    weights : np.ndarray
+
+    Examples
+    --------
+    >>> stratified_weights([0, 0, 1]).tolist()
+    [0.75, 0.75, 1.5]
+    """
+    strata = np.asarray(strata)
+    _, inverse, counts = np.unique(strata, return_inverse=True,
+                                   return_counts=True)
+    weights = 1 / counts[inverse]
+    return weights * len(strata) / weights.sum()
+
+
+@attr.s
+class WindowSampler(Sampler):
+    """Sample batches of windows at random with replacement
+
+    The batches of indices are drawn lazily, so that only O(batch_size)
+    memory is used regardless of the number of samples. The indices have the
+    same layout as `WindowedData`, ``i + nwindows * (iy * nx + ix)``.
+
+    Parameters
+    ----------
+    nwindows : int
+        number of windows along the time dimension
+    ny, nx : int
+    num_samples : int
+        number of windows per epoch
+    batch_size : int
+    weights : array_like, optional
+        relative probability of each y row. See `stratified_weights`.
+        Defaults to uniform.
+    seed : int, optional
+        if given, the samples are determined by the seed and the epoch
+    rank, num_replicas : int
+        for distributed training, every batch is split between
+        ``num_replicas`` processes, and this sampler yields the part of
+        process ``rank``. The processes must use the same seed, so that their
+        parts are disjoint. The batches are rounded up to a multiple of
+        ``num_replicas``, so every process gets the same number of samples.
+
+    Yields
+    ------
+    inds : np.ndarray
+        batch of indices
+    """
+    nwindows = attr.ib()
+    ny = attr.ib()
+    nx = attr.ib()
+    num_samples = attr.ib()
+    batch_size = attr.ib()
+    weights = attr.ib(default=None)
+    seed = attr.ib(default=None)
+    epoch = attr.ib(default=0)
+    rank = attr.ib(default=0)
+    num_replicas = attr.ib(default=1)
+
+    def __attrs_post_init__(self):
+        if self.weights is not None:
+            p = np.asarray(self.weights, dtype=np.float64)
+            if p.shape != (self.ny,):
+                raise ValueError("weights must have one entry per y row")
+            self._p = p / p.sum()
+        else:
+            self._p = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return -(-self.num_samples // self.batch_size)
+
+    def __iter__(self):
+        if self.seed is None:
+            rng = np.random.RandomState()
+        else:
+            rng = np.random.RandomState([self.seed, self.epoch])
+
+        for start in range(0, self.num_samples, self.batch_size):
+            n = min(self.batch_size, self.num_samples - start)
+            n = -(-n // self.num_replicas) * self.num_replicas
+            if self._p is None:
+                iy = rng.randint(self.ny, size=n)
+            else:
+                iy = rng.choice(self.ny, size=n, p=self._p)
+            ix = rng.randint(self.nx, size=n)
+            i = rng.randint(self.nwindows, size=n)
+            inds = i + self.nwindows * (iy * self.nx + ix)
+            yield inds[self.rank::self.num_replicas]
+
+
+def _load_block(fields, start, stop):
+    """Load a time slice of a nested dict of (possibly lazy) arrays
+
+    All the arrays are computed together, so that dask can share the reads
+    of the underlying files.
+    """
+    keys = [(group, key) for group in fields for key in fields[group]]
+    arrays = [fields[group][key][start:stop] for group, key in keys]
+
+    if not all(isinstance(arr, np.ndarray) for arr in arrays):
+        import dask
+        arrays = dask.compute(*arrays)
+
+    block = {group: {} for group in fields}
+    for (group, key), arr in zip(keys, arrays):
+        block[group][key] = np.asarray(arr)
+    return block
+
+
+def _batch_size(batch):
+    group = next(iter(batch.values()))
+    return next(iter(group.values())).size(1)
+
+
+def _slice_batch(batch, start, stop):
+    return {
+        group: {key: val[:, start:stop] for key, val in d.items()}
+        for group, d in batch.items()
+    }
+
+
+def _rebatch(batches, batch_size):
+    """Regroup a stream of variably sized batches into batches of batch_size
+    """
+    pending, npending = [], 0
+    for batch in batches:
+        pending.append(batch)
+        npending += _batch_size(batch)
+
+        while npending >= batch_size:
+            batch = _concat_batches(pending)
+            yield _slice_batch(batch, 0, batch_size)
+            npending -= batch_size
+            pending = [_slice_batch(batch, batch_size, None)] \
+                if npending else []
+
+    if npending:
+        yield _concat_batches(pending)
+
+
+def _concat_batches(batches):
+    if len(batches) == 1:
+        return batches[0]
+    return {
+        group: {key: torch.cat([b[group][key] for b in batches], 1)
+                for key in batches[0][group]}
+        for group in batches[0]
+    }
+
+
+@attr.s
+class BlockWindowStream(IterableDataset):
+    """Stream batches of windows from time-contiguous blocks of lazy arrays
+
+    Only ``buffer_blocks`` blocks of time are in memory at once. Each block
+    contains ``block_size`` windows, and overlaps the following block by
+    ``window_size - 1`` time points, so that every window of the full
+    dataset belongs to exactly one block. The blocks are visited in a random
+    order, and the windows of the blocks in the buffer are shuffled together.
+
+    Parameters
+    ----------
+    fields : dict
+        nested dict of arrays with time as the first dimension. These can be
+        dask arrays.
+    window_size : int
+    batch_size : int
+    block_size : int, optional
+        number of windows per block. Defaults to ``max(window_size, 16)``.
+    buffer_blocks : int
+        number of blocks to shuffle together
+    num_samples : int, optional
+        stop after this many windows
+    shuffle : bool
+    seed : int, optional
+        if given, the order is determined by the seed and the epoch (see
+        `set_epoch`)
+
+    Yields
+    ------
+    batch : dict
+        nested dict of (window_size, batch, z) tensors
+    """
+    fields = attr.ib()
+    window_size = attr.ib()
+    batch_size = attr.ib()
+    block_size = attr.ib(default=None)
+    buffer_blocks = attr.ib(default=4)
+    num_samples = attr.ib(default=None)
+    shuffle = attr.ib(default=True)
+    seed = attr.ib(default=None)
+    epoch = attr.ib(default=0)
+
+    def __attrs_post_init__(self):
+        if self.block_size is None:
+            self.block_size = max(self.window_size, 16)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    @property
+    def _shape(self):
+        group = next(iter(self.fields.values()))
+        return next(iter(group.values())).shape
+
+    @property
+    def nwindows(self):
+        return self._shape[0] - self.window_size + 1
+
+    @property
+    def ncolumns(self):
+        return int(np.prod(self._shape[1:3]))
+
+    @property
+    def num_windows(self):
+        n = self.nwindows * self.ncolumns
+        if self.num_samples:
+            n = min(n, self.num_samples)
+        return n
+
+    def __len__(self):
+        return -(-self.num_windows // self.batch_size)
+
+    def _windowed_block(self, start):
+        stop = min(start + self.block_size, self.nwindows)
+        block = _load_block(self.fields, start,
+                            stop + self.window_size - 1)
+        return DictDataset({
+            group: DictDataset({
+                key: WindowedData(val, self.window_size)
+                for key, val in block[group].items()
+            })
+            for group in block
+        })
+
+    def _iter_windows(self, rng):
+        """Yield batches of windows which may be smaller than batch_size"""
+        starts = np.arange(0, self.nwindows, self.block_size)
+        if self.shuffle:
+            rng.shuffle(starts)
+
+        for k in range(0, len(starts), self.buffer_blocks):
+            datasets = [self._windowed_block(start)
+                        for start in starts[k:k + self.buffer_blocks]]
+            offsets = np.cumsum([0] + [len(d) for d in datasets])
+
+            inds = np.arange(offsets[-1])
+            if self.shuffle:
+                rng.shuffle(inds)
+
+            for batch_start in range(0, len(inds), self.batch_size):
+                batch = inds[batch_start:batch_start + self.batch_size]
+                block_ids = np.searchsorted(offsets, batch, side='right') - 1
+                yield _concat_batches([
+                    datasets[b][batch[block_ids == b] - offsets[b]]
+                    for b in np.unique(block_ids)
+                ])
+
+    def __iter__(self):
+        if self.seed is None:
+            rng = np.random.RandomState()
+        else:
+            rng = np.random.RandomState([self.seed, self.epoch])
+        remaining = self.num_windows
+
+        def windows():
+            nonlocal remaining
+            for batch in self._iter_windows(rng):
+                n = min(_batch_size(batch), remaining)
+                yield _slice_batch(batch, 0, n)
+                remaining -= n
+                if remaining == 0:
+                    return
+
+        return _rebatch(windows(), self.batch_size)
@@ -0,0 +1,198 @@
+"""Train several independently initialized models at once
+
+The weights of the ensemble members are stacked along a leading dimension and
+applied with batched matrix multiplies. The members are folded into the batch
+dimension of the data, so that `model.ForcedStepper` can time step an ensemble
+without any changes. For a batch of size B, the rows ``e * B:(e + 1) * B`` of
+the packed state belong to member ``e``.
+"""
+import torch
+from torch import nn
+from toolz import first, valmap
+
+from .constraints import ConstraintCache
+from .model import (RHS, _from_dict, _to_dict, _set_qt, enforce_precip_qt,
+                    precip_projection)
+
+
+class EnsembleLinear(nn.Module):
+    """A stack of linear layers applied to inputs of shape (ens, batch, in)"""
+
+    def __init__(self, layers):
+        super(EnsembleLinear, self).__init__()
+        self.weight = nn.Parameter(
+            torch.stack([layer.weight.detach().t() for layer in layers]))
+        self.bias = nn.Parameter(
+            torch.stack([layer.bias.detach()[None] for layer in layers]))
+
+    def forward(self, x):
+        return torch.baddbmm(self.bias, x, self.weight)
+
+
+class EnsembleBatchNorm(nn.Module):
+    """A stack of `nn.BatchNorm1d` layers applied to (ens, batch, features)
+
+    The statistics are computed separately for every member.
+    """
+
+    def __init__(self, layers):
+        super(EnsembleBatchNorm, self).__init__()
+        bn = first(layers)
+        self.eps = bn.eps
+        self.momentum = bn.momentum
+
+        def stack(key):
+            return torch.stack([getattr(layer, key).detach()[None]
+                                for layer in layers])
+
+        self.weight = nn.Parameter(stack('weight'))
+        self.bias = nn.Parameter(stack('bias'))
+        self.register_buffer('running_mean', stack('running_mean'))
+        self.register_buffer('running_var', stack('running_var'))
+
+    def forward(self, x):
+        if self.training:
+            n = x.size(1)
+            mean = x.mean(1, keepdim=True)
+            var = x.var(1, unbiased=False, keepdim=True)
+            with torch.no_grad():
+                self.running_mean.lerp_(mean, self.momentum)
+                self.running_var.lerp_(var * n / max(n - 1, 1), self.momentum)
+        else:
+            mean, var = self.running_mean, self.running_var
+
+        return (x - mean) / torch.sqrt(var + self.eps) * self.weight + self.bias
+
+
+class EnsembleRHS(nn.Module):
+    """Evaluate several `model.RHS` objects with stacked weights
+
+    The inputs have shape (ens * batch, features). The members share the
+    scaler and hyperparameters of the first member.
+
+    Examples
+    --------
+    >>> members = [RHS(m, hidden=(256,), scaler=scaler) for seed in seeds]
+    >>> ens = EnsembleRHS(members)
+    >>> rhs = ens.member(0)
+    """
+    forcing_names = RHS.forcing_names
+
+    def __init__(self, members):
+        super(EnsembleRHS, self).__init__()
+        rhs = first(members)
+        self.size = len(members)
+        self.m = rhs.lin.out_features
+        self.scaler = rhs.scaler
+        self.num_2d_inputs = rhs.num_2d_inputs
+        self.precip_positive = rhs.precip_positive
+        self.radiation = rhs.radiation
+
+        layers = []
+        for k, layer in enumerate(rhs.mlp):
+            if isinstance(layer, nn.Linear):
+                layers.append(EnsembleLinear([rhs.mlp[k] for rhs in members]))
+            else:
+                layers.append(layer)
+        self.mlp = nn.Sequential(*layers)
+        self.bn = EnsembleBatchNorm([rhs.bn for rhs in members])
+        self.precip_constraint = ConstraintCache(precip_projection)
+
+        # the linear term is not used by RHS.packed, but is stored so that
+        # the members can be saved exactly
+        self.register_buffer('lin_weight', torch.stack(
+            [rhs.lin.weight.detach() for rhs in members]))
+
+    @property
+    def hidden(self):
+        return tuple(layer.weight.size(-1) for layer in self.mlp
+                     if isinstance(layer, EnsembleLinear))[:-1]
+
+    def _stack(self, x):
+        return x.view(self.size, -1, x.size(-1))
+
+    def forward(self, x, force, w):
+        return _to_dict(self.packed(x, force, w)), {}
+
+    def packed(self, x, force, w):
+        """Compute the source terms packed as ``[sl, qt]``"""
+        x = self.scaler(x)
+        f = self.scaler(force)
+
+        data_2d = torch.cat((f['SHF'], f['LHF'], f['SOLIN'],
+                             f['sl'], f['qt']), -1)
+        data_2d = self.bn(self._stack(data_2d))
+
+        x = torch.cat((self._stack(_from_dict(x)), data_2d), -1)
+        y = self.mlp(x)
+        y = y.view(-1, y.size(-1))
+
+        if self.precip_positive:
+            qt = _to_dict(y)['qt']
+            y = _set_qt(y, enforce_precip_qt(qt, force['LHF'], w,
+                                             self.precip_constraint(w)))
+
+        return y
+
+    def member(self, e):
+        """Return a copy of the ``e``-th member as a `model.RHS`"""
+        rhs = RHS(self.m, hidden=self.hidden, scaler=self.scaler,
+                  num_2d_inputs=self.num_2d_inputs,
+                  precip_positive=self.precip_positive,
+                  radiation=self.radiation)
+        rhs.to(self.lin_weight.device)
+        linears = [layer for layer in rhs.mlp if isinstance(layer, nn.Linear)]
+        stacked = [layer for layer in self.mlp
+                   if isinstance(layer, EnsembleLinear)]
+
+        with torch.no_grad():
+            for layer, ens in zip(linears, stacked):
+                layer.weight.copy_(ens.weight[e].t())
+                layer.bias.copy_(ens.bias[e, 0])
+            rhs.lin.weight.copy_(self.lin_weight[e])
+            for key in ['weight', 'bias', 'running_mean', 'running_var']:
+                getattr(rhs.bn, key).copy_(getattr(self.bn, key)[e, 0])
+        rhs.train(self.training)
+        return rhs
+
+
+def tile_batch(batch, n):
+    """Repeat the time-dependent data of a batch ``n`` times along the batch
+    dimension"""
+    out = {group: valmap(lambda x: x.repeat(1, n, 1), batch[group])
+           for group in ['prognostic', 'forcing']}
+    out['constant'] = batch['constant']
+    return out
+
+
+def member_outputs(y, n):
+    """Split the output of an ensemble time stepper into a list of outputs"""
+    prog = valmap(lambda x: x.view(x.size(0), n, -1, x.size(-1)),
+                  y['prognostic'])
+    return [{'prognostic': {key: val[:, e] for key, val in prog.items()}}
+            for e in range(n)]
+
+
+def ensemble_loss(loss, stepper, n):
+    """Return a function computing the loss of each member of an ensemble
+
+    Parameters
+    ----------
+    loss : callable
+        ``loss(batch, y)`` returns the loss of a single model
+    stepper : nn.Module
+        time stepper of an `EnsembleRHS`
+    n : int
+        size of the ensemble
+
+    Returns
+    -------
+    callable
+        ``fn(batch)`` returns a tensor with shape (n,). The members do not
+        share any weights, so the gradient of the sum with respect to the
+        weights of one member is the gradient of its own loss.
+    """
+    def fn(batch):
+        y = stepper(tile_batch(batch, n))
+        return torch.stack([loss(batch, y_e) for y_e in member_outputs(y, n)])
+    return fn
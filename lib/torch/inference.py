@@ -0,0 +1,186 @@
+"""Versions of trained models which are optimized for inference
+
+The functions in this module take a trained `ForcedStepper` and return an
+equivalent model which is only valid in eval mode, but runs faster.
+"""
+import copy
+
+import numpy as np
+import torch
+from torch import nn
+
+from .constraints import ConstraintCache
+from .model import (ForcedStepper, RHS, _set_qt, _to_dict,
+                    enforce_precip_qt, precip_projection)
+
+
+def _segments(rhs):
+    """Names and sizes of the inputs packed by `FoldedRHS`"""
+    nz = rhs.lin.out_features // 2
+    return [('prognostic', 'sl', nz), ('prognostic', 'qt', nz),
+            ('forcing', 'SHF', 1), ('forcing', 'LHF', 1),
+            ('forcing', 'SOLIN', 1), ('forcing', 'sl', nz),
+            ('forcing', 'qt', nz)]
+
+
+def input_affine(rhs):
+    """Affine map from the packed raw inputs to the input of ``rhs.mlp``
+
+    This combines the normalization by ``rhs.scaler`` and the batch norm
+    layer, using its running statistics.
+
+    Returns
+    -------
+    scale, offset : torch.Tensor
+        the input of the MLP is ``scale * x + offset``
+    """
+    scales, means = rhs.scaler.args
+    scale, offset = [], []
+    for _, key, n in _segments(rhs):
+        if key in scales and key in means:
+            sig = scales[key].double() + 1e-7
+            mu = means[key].double()
+            scale.append(torch.ones(n, dtype=torch.float64) / sig)
+            offset.append(-mu.expand(n) / sig)
+        else:
+            scale.append(torch.ones(n, dtype=torch.float64))
+            offset.append(torch.zeros(n, dtype=torch.float64))
+
+    scale = torch.cat(scale)
+    offset = torch.cat(offset)
+
+    # apply the batch norm to the 2D inputs and the forcings
+    bn = rhs.bn
+    n_bn = bn.num_features
+    sd = torch.sqrt(bn.running_var.double() + bn.eps)
+    gamma = bn.weight.detach().double() if bn.affine else 1.0
+    beta = bn.bias.detach().double() if bn.affine else 0.0
+    mean = bn.running_mean.double()
+
+    scale[-n_bn:] = scale[-n_bn:] * gamma / sd
+    offset[-n_bn:] = (offset[-n_bn:] - mean) * gamma / sd + beta
+
+    return scale, offset
+
+
+def fold_linear(linear, scale, offset):
+    """Fold an affine transformation of the inputs into a linear layer"""
+    folded = copy.deepcopy(linear)
+    weight = linear.weight.detach().double()
+    bias = linear.bias.detach().double()
+    with torch.no_grad():
+        folded.weight.copy_(weight * scale)
+        folded.bias.copy_(bias + weight @ offset)
+    return folded
+
+
+class FoldedRHS(nn.Module):
+    """`RHS` with the normalization folded into the first linear layer
+
+    The inputs are packed into a single buffer, which is reused between calls
+    when gradients are not needed.
+    """
+    forcing_names = RHS.forcing_names
+
+    def __init__(self, rhs):
+        super(FoldedRHS, self).__init__()
+        scale, offset = input_affine(rhs)
+        layers = list(copy.deepcopy(rhs.mlp))
+        layers[0] = fold_linear(layers[0], scale, offset)
+        self.mlp = nn.Sequential(*layers)
+        self.precip_positive = rhs.precip_positive
+        self.segments = _segments(rhs)
+        self.precip_constraint = ConstraintCache(precip_projection)
+        self._buffer = None
+
+    def pack(self, x, force):
+        inputs = {'prognostic': x, 'forcing': force}
+        tensors = [inputs[group][key] for group, key, _ in self.segments]
+
+        if torch.is_grad_enabled():
+            return torch.cat(tensors, -1)
+
+        shape = tensors[0].shape[:-1] + (sum(n for *_, n in self.segments),)
+        if self._buffer is None or self._buffer.shape != shape:
+            self._buffer = tensors[0].new_empty(shape)
+        return torch.cat(tensors, -1, out=self._buffer)
+
+    def forward(self, x, force, w):
+        return _to_dict(self.packed(x, force, w)), {}
+
+    def packed(self, x, force, w):
+        y = self.mlp(self.pack(x, force))
+
+        if self.precip_positive:
+            qt = _to_dict(y)['qt']
+            y = _set_qt(y, enforce_precip_qt(qt, force['LHF'], w,
+                                             self.precip_constraint(w)))
+
+        return y
+
+
+def optimize_for_inference(stepper):
+    """Return a copy of a trained ForcedStepper for fast inference
+
+    The scaler and the batch norm statistics are folded into the first layer
+    of the neural network. The result gives the same output as ``stepper``
+    in eval mode. The mode of ``stepper`` is not changed.
+    """
+    return _like(stepper, FoldedRHS(stepper.rhs))
+
+
+def _like(stepper, rhs):
+    """ForcedStepper with the settings of ``stepper`` and another rhs"""
+    return ForcedStepper(rhs, stepper.h, stepper.nsteps,
+                         diagnostics=stepper.diagnostics,
+                         method=stepper.method, rtol=stepper.rtol,
+                         atol=stepper.atol).eval()
+
+
+def quantize_dynamic(stepper, dtype=torch.qint8):
+    """Return a copy of a trained ForcedStepper with quantized linear layers
+
+    The weights of the linear layers of the MLP are stored as 8 bit integers,
+    and their inputs are quantized on the fly. The scaler and batch norm are
+    kept in floating point, so that the quantized layers see normalized
+    inputs. The result is only valid in eval mode on the CPU, and can be used
+    with `interface.column_run` and `interface.rhs`.
+    """
+    rhs = copy.deepcopy(stepper.rhs).cpu().eval()
+    rhs.mlp = torch.quantization.quantize_dynamic(rhs.mlp, {nn.Linear},
+                                                  dtype=dtype)
+    return _like(stepper, rhs)
+
+
+def export_numpy(stepper, path):
+    """Save a trained ForcedStepper for the NumPy runtime
+
+    The normalization is folded into the first layer as in
+    `optimize_for_inference`. The file can be loaded without torch using
+    `lib.npmodel.NumpyStepper.load`.
+
+    Parameters
+    ----------
+    stepper : ForcedStepper
+        an Euler time stepper
+    path : str
+        output path. numpy appends ".npz" if it is missing.
+    """
+    if stepper.method != 'euler':
+        raise ValueError("Only Euler time steppers can be exported")
+    rhs = FoldedRHS(stepper.rhs)
+    linears = [layer for layer in rhs.mlp if isinstance(layer, nn.Linear)]
+
+    arrays = {}
+    for k, layer in enumerate(linears):
+        arrays[f'weight_{k}'] = layer.weight.detach().cpu().numpy()
+        arrays[f'bias_{k}'] = layer.bias.detach().cpu().numpy()
+
+    np.savez(path,
+             nlayers=len(linears),
+             inputs=np.array([f'{group}/{key}'
+                              for group, key, _ in rhs.segments]),
+             h=float(stepper.h),
+             nsteps=stepper.nsteps,
+             precip_positive=rhs.precip_positive,
+             **arrays)
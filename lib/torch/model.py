@@ -9,15 +9,17 @@ from collections import defaultdict
 import torch
 from toolz import assoc, first, valmap
 from torch import nn
-from .constraints import apply_linear_constraint
+from torch.utils.checkpoint import checkpoint
+from .constraints import LinearConstraints, ConstraintCache
 
 logger = logging.getLogger(__name__)
 
 
 def _to_dict(x):
+    nz = x.size(-1) // 2
     return {
-        'sl': x[..., :34],
-        'qt': x[..., 34:]
+        'sl': x[..., :nz],
+        'qt': x[..., nz:]
     }
 
 
@@ -33,6 +35,120 @@ def _euler_step(prog, src, h):
     return prog
 
 
+def _set_qt(x, qt):
+    """Replace the moisture part of a packed state or tendency
+
+    This is done in place when gradients are not needed.
+    """
+    nz = x.size(-1) // 2
+    if torch.is_grad_enabled():
+        return torch.cat((x[..., :nz], qt), -1)
+    x[..., nz:] = qt
+    return x
+
+
+def pack_forcing(forcing, names):
+    """Concatenate a dict of forcings along the last dimension
+
+    Returns
+    -------
+    packed : torch.Tensor
+    layout : list
+        (name, size) pairs which can be passed to `unpack_forcing`
+    """
+    layout = [(name, forcing[name].size(-1)) for name in names]
+    return torch.cat([forcing[name] for name in names], -1), layout
+
+
+def unpack_forcing(packed, layout):
+    """Dict of views into a packed forcing tensor"""
+    forcing = {}
+    start = 0
+    for name, size in layout:
+        forcing[name] = packed[..., start:start + size]
+        start += size
+    return forcing
+
+
+def euler_step(f, x, dt):
+    return x + dt * f(x)
+
+
+def heun_step(f, x, dt):
+    k1 = f(x)
+    k2 = f(x + dt * k1)
+    return x + dt / 2 * (k1 + k2)
+
+
+def rk4_step(f, x, dt):
+    k1 = f(x)
+    k2 = f(x + dt / 2 * k1)
+    k3 = f(x + dt / 2 * k2)
+    k4 = f(x + dt * k3)
+    return x + dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+
+
+integrators = {
+    'euler': euler_step,
+    'heun': heun_step,
+    'rk4': rk4_step,
+}
+
+
+def adaptive_heun_step(f, x, h, dt, rtol=1e-3, atol=1e-6, post=None,
+                       max_substeps=1000):
+    """Integrate from 0 to h with adaptive Heun substeps
+
+    The difference between the Euler and Heun solutions estimates the local
+    error. The same substep is used for the whole batch, so the largest error
+    in the batch controls the step size.
+
+    Parameters
+    ----------
+    f : callable
+        tendency
+    x : torch.Tensor
+    h : float
+        total time to integrate
+    dt : float
+        initial substep
+    post : callable, optional
+        applied to the state after every accepted substep
+    max_substeps : int
+        maximum number of attempted substeps
+
+    Raises
+    ------
+    RuntimeError
+        if the integration does not reach h within ``max_substeps``
+    """
+    h = float(h)
+    dt = float(dt)
+    t = 0.0
+    for _ in range(max_substeps):
+        if t >= h * (1 - 1e-6):
+            return x
+        dt = min(dt, h - t)
+        k1 = f(x)
+        x_euler = x + dt * k1
+        x_heun = x + dt / 2 * (k1 + f(x_euler))
+
+        scale = atol + rtol * x_heun.detach().abs()
+        err = float(((x_heun - x_euler).detach().abs() / scale).max())
+
+        if err <= 1:
+            x = x_heun if post is None else post(x_heun)
+            t += dt
+
+        # the error of the Euler step scales like dt^2
+        dt = dt * min(5.0, max(0.2, 0.9 / max(err, 1e-10) ** 0.5))
+
+    if t < h * (1 - 1e-6):
+        raise RuntimeError(f"Adaptive integration only reached t={t} of "
+                           f"h={h} in {max_substeps} substeps")
+    return x
+
+
 def large_scale_forcing(i, data):
     forcing = {
         key: val[i - 1]
@@ -54,14 +170,55 @@ def compute_diagnostics(steps, lsf, w, dt):
     """Routine for computing diagnostics such as precipitation or MSE budgets
     """
 
-    prog_start, prog_lsf, prog_nn = steps
-    q_start, q_lsf, q_nn = [mass_integrate(prog['qt'], w)
-                            for prog in steps]
-    s_start, s_lsf, s_nn = [mass_integrate(prog['sl'], w)
-                            for prog in steps]
+    start, lsf, nn = [
+        torch.cat((mass_integrate(prog['sl'], w),
+                   mass_integrate(prog['qt'], w)), -1)
+        for prog in steps
+    ]
+    return _diagnostics_from_integrals(start, lsf, nn, dt)
+
+
+def _column_integrals(x, weights):
+    """Mass integrals of sl and qt for packed states
+
+    Parameters
+    ----------
+    x : (..., 2 * nz)
+        packed states
+    weights : (2 * nz, 2)
+        see `_integral_weights`
+
+    Returns
+    -------
+    integrals : (..., 2)
+        the integrals of sl and qt
+    """
+    return x @ weights
+
+
+def _integral_weights(w):
+    """Matrix which computes the mass integrals of sl and qt in one matmul
+    """
+    nz = w.size(-1)
+    weights = w.new_zeros(2 * nz, 2)
+    weights[:nz, 0] = w
+    weights[nz:, 1] = w
+    return weights
+
+
+def _diagnostics_from_integrals(start, lsf, nn, dt):
+    """Diagnostics from the column integrals of sl and qt
+
+    Parameters
+    ----------
+    start, lsf, nn : (..., 2)
+        integrals before the time step, after the large scale forcing, and
+        after the neural network tendency
+    """
+    s_start, q_start = start[..., :1], start[..., 1:]
+    s_lsf, q_lsf = lsf[..., :1], lsf[..., 1:]
+    s_nn, q_nn = nn[..., :1], nn[..., 1:]
 
-    evap = lsf['LHF'] * 86400 / 2.51e6
-    prec = evap - (q_nn - q_lsf)/dt
     return {
         'QLSF': (q_lsf - q_start)/dt/86400/1000**2,
         'QNN': (q_nn - q_lsf)/dt/86400/1000**2,
@@ -74,7 +231,18 @@ def mass_integrate(x, w):
     return (x * w).sum(-1, keepdim=True)
 
 
-def enforce_precip_qt(fqt, lhf, w, **kwargs):
+def precip_projection(w):
+    """Constraint that the precipitation implied by a moisture tendency is
+    positive
+
+    The tendency is adjusted by a constant in the vertical. The layer mass
+    ``w`` can have a leading batch dimension of size 1.
+    """
+    A = -w.reshape(1, -1) / 1000.
+    return LinearConstraints(A, torch.ones_like(A), inequality=True)
+
+
+def enforce_precip_qt(fqt, lhf, w, constraint=None):
     """Adjust moisture tendency to be positive
 
     .. math::
@@ -86,12 +254,14 @@ def enforce_precip_qt(fqt, lhf, w, **kwargs):
     fqt : mm/day
     lhf : W/m^2
     w : kg /m^2
+    constraint : LinearConstraints, optional
+        the result of ``precip_projection(w)``, if it is already computed
 
     """
+    if constraint is None:
+        constraint = precip_projection(w)
     evap = lhf * 86400 / 2.51e6
-    return apply_linear_constraint(lambda x: -mass_integrate(x, w)/1000.,
-                                   -evap, fqt, inequality=True,
-                                   **kwargs)
+    return constraint(fqt, -evap)
 
 
 def where(cond, x, y):
@@ -101,12 +271,15 @@ def where(cond, x, y):
 
 def _fix_moisture(q, w, eps=1e-9):
     """Remove negative moisture points while conserving total moisture"""
-    cond = q < eps
-    total_moisture = mass_integrate(q, w)
-    moisture_lack = mass_integrate(cond.float(), w) * eps
-    moisture_valid = mass_integrate((1-cond.float()) * q, w)
-    alpha = (total_moisture - moisture_lack) / moisture_valid
-    return where(cond, eps, q * alpha)
+    cond = (q < eps).to(q.dtype)
+    valid = (1 - cond) * q
+
+    # the total, lacking, and valid moisture in one matmul
+    integrals = torch.stack((q, cond, valid), -2) @ w.reshape(-1)
+    total_moisture, moisture_lack, moisture_valid = integrals.unbind(-1)
+    alpha = ((total_moisture - moisture_lack * eps) /
+             moisture_valid).unsqueeze(-1)
+    return cond * eps + valid * alpha
 
 
 def mlp(layer_sizes):
@@ -121,6 +294,9 @@ def mlp(layer_sizes):
 
 
 class RHS(nn.Module):
+    # forcing variables used by forward
+    forcing_names = ('sl', 'qt', 'SHF', 'LHF', 'SOLIN')
+
     def __init__(self,
                  m,
                  hidden=(),
@@ -144,11 +320,13 @@ class RHS(nn.Module):
         self.radiation = radiation
         self.precip_positive = precip_positive
         self.num_2d_inputs = num_2d_inputs
+        self.precip_constraint = ConstraintCache(precip_projection)
 
     def forward(self, x, force, w):
+        return _to_dict(self.packed(x, force, w)), {}
 
-        progs = x
-        diags = {}
+    def packed(self, x, force, w):
+        """Compute the source terms packed as ``[sl, qt]``"""
         x = self.scaler(x)
         f = self.scaler(force)
 
@@ -159,12 +337,13 @@ class RHS(nn.Module):
         x = _from_dict(x)
         x = torch.cat((x, data_2d), -1)
         y = self.mlp(x) #+ self.lin(x)
-        src = _to_dict(y)
 
         if self.precip_positive:
-            src['qt'] = enforce_precip_qt(src['qt'], force['LHF'], w)
+            qt = _to_dict(y)['qt']
+            y = _set_qt(y, enforce_precip_qt(qt, force['LHF'], w,
+                                             self.precip_constraint(w)))
 
-        return src, diags
+        return y
 
 
 def rhs_hidden_from_state_dict(state):
@@ -187,11 +366,59 @@ def rhs_hidden_from_state_dict(state):
 
 
 class ForcedStepper(nn.Module):
-    def __init__(self, rhs, h, nsteps):
+    def __init__(self, rhs, h, nsteps, diagnostics='step', checkpoint=None,
+                 truncate=None, method='euler', rtol=1e-3, atol=1e-6):
+        """
+        Parameters
+        ----------
+        rhs : RHS
+        h : float
+            time step of the data
+        nsteps : int
+            number of substeps per time step
+        diagnostics : str or None
+            If 'step', the diagnostics are averaged over every substep. If
+            'window', they are computed after the rollout from the output
+            states. For Euler stepping these agree because the large-scale
+            forcing is not applied. If None, no diagnostics are computed.
+        checkpoint : int, optional
+            When training, recompute the forward pass in segments of this
+            many time steps during the backward pass instead of storing the
+            whole graph. The batch norm running statistics are updated again
+            when a segment is recomputed.
+        truncate : int, optional
+            When training, truncate backpropagation through time every
+            ``truncate`` time steps.
+
+        method : str
+            time integration scheme. One of 'euler', 'heun', 'rk4', or
+            'adaptive'. The fixed step schemes take ``nsteps`` substeps per
+            time step. 'adaptive' uses an embedded Euler-Heun pair starting
+            from a substep of ``h / nsteps``, and chooses the substep for the
+            whole batch to satisfy the tolerances ``rtol`` and ``atol``.
+
+        The 'step' diagnostics are not computed when checkpointing or
+        truncating.
+        """
         super(ForcedStepper, self).__init__()
+        if diagnostics not in (None, 'step', 'window'):
+            raise ValueError(f"Unknown diagnostics mode: {diagnostics}")
+        if method not in tuple(integrators) + ('adaptive',):
+            raise ValueError(f"Unknown integration method: {method}")
         self.nsteps = nsteps
         self.h = h
         self.rhs = rhs
+        self.diagnostics = diagnostics
+        self.checkpoint = checkpoint
+        self.truncate = truncate
+        self.method = method
+        self.rtol = rtol
+        self.atol = atol
+
+    @property
+    def forcing_names(self):
+        """The forcing variables which are needed to run the model"""
+        return self.rhs.forcing_names
 
     def forward(self, data: dict):
         """
@@ -206,53 +433,177 @@ class ForcedStepper(nn.Module):
         w = data['constant']['w']
 
         window_size = first(prog.values()).size(0)
-        prog = valmap(lambda prog: prog[0], prog)
-        h = self.h
-        nsteps = self.nsteps
+        state = _from_dict(valmap(lambda prog: prog[0], prog))
+        forcing = [large_scale_forcing(i, data)
+                   for i in range(1, window_size)]
+
+        steps, diagnostics = self._rollout(state, forcing, w)
+
+        if self.diagnostics == 'window':
+            integrals = _column_integrals(steps, _integral_weights(w))
+            diagnostics = _diagnostics_from_integrals(
+                integrals[:-1], integrals[:-1], integrals[1:], self.h)
+        else:
+            diagnostics = valmap(torch.stack, diagnostics)
+
+        y = data.copy()
+        y['prognostic'] = _to_dict(steps)
+        y['diagnostic'] = diagnostics
+        return y
+
+    def forward_packed(self, state, forcing, layout, w):
+        """Run the model with packed inputs and outputs
+
+        Parameters
+        ----------
+        state : (batch, 2 * nz)
+            initial state packed as ``[sl, qt]``
+        forcing : (time, batch, nf)
+            forcing packed by `pack_forcing`
+        layout : list
+            layout returned by `pack_forcing`
+        w : (nz,)
+            layer mass
+
+        Returns
+        -------
+        steps : (time, batch, 2 * nz)
+        """
+        forcing = [unpack_forcing(forcing[i], layout)
+                   for i in range(forcing.size(0) - 1)]
+        steps, _ = self._rollout(state, forcing, w)
+        return steps
+
+    def _rollout(self, state, forcing, w):
+        """Time step a packed state
+
+        When gradients are not needed, the state is updated in place using
+        two preallocated buffers.
+
+        Parameters
+        ----------
+        state : (batch, 2 * nz)
+        forcing : list of dicts
+            the forcing used for each time step
+        w : (nz,)
+
+        Returns
+        -------
+        steps : (len(forcing) + 1, batch, 2 * nz)
+        diagnostics : dict of lists
+        """
+        if torch.is_grad_enabled() and (self.checkpoint or self.truncate):
+            return self._rollout_segments(state, forcing, w), {}
+
+        nsteps, dt = self._substeps()
+        inplace = not torch.is_grad_enabled()
 
         # output array
-        steps = {key: [prog[key]] for key in prog}
+        steps = state.new_empty((len(forcing) + 1, ) + state.shape)
+        steps[0] = state
+        if inplace:
+            buffers = [state.clone(), torch.empty_like(state)]
+            state = buffers[0]
+
         # diagnostics
+        step_diagnostics = self.diagnostics == 'step'
         diagnostics = defaultdict(list)
+        if step_diagnostics:
+            weights = _integral_weights(w)
+            integrals = _column_integrals(state, weights)
 
-        for i in range(1, window_size):
+        for i, lsf in enumerate(forcing, 1):
             diag_step = defaultdict(lambda: 0)
             for j in range(nsteps):
-
-                # store old state
-                prog0 = prog
-
-                # apply large scale forcings
-                lsf = large_scale_forcing(i, data)
-                # prog = _euler_step(prog, lsf, h / nsteps)
-                prog1 = prog
-
                 # compute and apply rhs using neural network
-                src, _ = self.rhs(prog, lsf, data['constant']['w'])
-                prog = _euler_step(prog, src, h / nsteps)
-                prog['qt'] = _fix_moisture(prog['qt'], data['constant']['w'])
-                prog2 = prog
+                new_state = self._substep(state, lsf, w, dt,
+                                          out=buffers[1] if inplace else None)
+
+                if step_diagnostics:
+                    new_integrals = _column_integrals(new_state, weights)
+                    diags = _diagnostics_from_integrals(
+                        integrals, integrals, new_integrals, dt)
+                    integrals = new_integrals
 
-                diags = compute_diagnostics([prog0, prog1, prog2], lsf,
-                                            w=data['constant']['w'], dt=h/nsteps)
+                    # running average of diagnostics
+                    for key in diags:
+                        diag_step[key] = diag_step[key] + diags[key] / nsteps
 
-                # running average of diagnostics
-                for key in diags:
-                    diag_step[key] = diag_step[key] + diags[key] / nsteps
+                if inplace:
+                    buffers.reverse()
+                state = new_state
 
             # store accumulated diagnostics
             for key in diag_step:
                 diagnostics[key].append(diag_step[key])
 
             # store data
-            for key in prog:
-                steps[key].append(prog[key])
+            steps[i] = state
 
-        y = data.copy()
-        y['prognostic'] = valmap(torch.stack, steps)
-        y['diagnostic'] = valmap(torch.stack, diagnostics)
-        return y
+        return steps, diagnostics
 
+    def _substeps(self):
+        """Number and length of the substeps of each time step
+
+        The adaptive integrator takes a single substep of the full time step,
+        which it divides internally.
+        """
+        if self.method == 'adaptive':
+            return 1, self.h
+        return self.nsteps, self.h / self.nsteps
+
+    def _substep(self, state, lsf, w, dt, out=None):
+        """Advance a packed state by dt and fix negative moisture
+
+        If ``out`` is given, Euler steps are computed in place.
+        """
+        def rhs(x):
+            return self.rhs.packed(_to_dict(x), lsf, w)
+
+        def fix(x):
+            return _set_qt(x, _fix_moisture(_to_dict(x)['qt'], w))
+
+        if self.method == 'adaptive':
+            # the moisture is fixed after every accepted substep
+            return adaptive_heun_step(rhs, state, dt, self.h / self.nsteps,
+                                      rtol=self.rtol, atol=self.atol,
+                                      post=fix)
+        elif self.method == 'euler' and out is not None:
+            state = torch.add(state, rhs(state), alpha=float(dt), out=out)
+        else:
+            state = integrators[self.method](rhs, state, dt)
+        return fix(state)
+
+    def _step(self, state, lsf, w):
+        """Advance a packed state by one time step"""
+        nsteps, dt = self._substeps()
+        for j in range(nsteps):
+            state = self._substep(state, lsf, w, dt)
+        return state
+
+    def _run_segment(self, state, forcing, w, start):
+        steps = []
+        for i, lsf in enumerate(forcing, start):
+            if self.truncate and i > 0 and i % self.truncate == 0:
+                state = state.detach()
+            state = self._step(state, lsf, w)
+            steps.append(state)
+        return torch.stack(steps)
+
+    def _rollout_segments(self, state, forcing, w):
+        """Time step with gradient checkpointing or truncated backprop"""
+        segment_size = self.checkpoint or len(forcing)
+        steps = [state.unsqueeze(0)]
+        for start in range(0, len(forcing), segment_size):
+            segment = forcing[start:start + segment_size]
+            if self.checkpoint:
+                out = checkpoint(self._run_segment, state, segment, w, start,
+                                 use_reentrant=False)
+            else:
+                out = self._run_segment(state, segment, w, start)
+            state = out[-1]
+            steps.append(out)
+        return torch.cat(steps)
 
     @staticmethod
     def load_from_saved(d):
@@ -281,7 +632,8 @@ class ForcedStepper(nn.Module):
                           scaler_args=self.rhs.scaler.args)
         output_dict = {
             'rhs': (m, rhs_kwargs),
-            'stepper': dict(h=self.h, nsteps=self.nsteps),
+            'stepper': dict(h=self.h, nsteps=self.nsteps, method=self.method,
+                            rtol=self.rtol, atol=self.atol),
             'state': self.state_dict()
         }
 
@@ -1,3 +1,4 @@
+import attr
 import numpy as np
 import torch
 from toolz import curry
@@ -28,3 +29,48 @@ def scaler(scales, means, x):
         else:
             out[key] = x[key]
     return out
+
+
+@attr.s
+class Moments(object):
+    """Mean and variance along the last dimension of a stream of arrays
+
+    Moments of separate chunks can be combined using ``+``, which uses the
+    pairwise update formula of Chan et al. This allows the statistics to be
+    computed in a single streaming pass or in parallel.
+
+    Examples
+    --------
+    >>> x = np.random.rand(100, 3)
+    >>> m = Moments.from_array(x[:30]) + Moments.from_array(x[30:])
+    >>> np.allclose(m.var, x.var(axis=0))
+    True
+    """
+    count = attr.ib(default=0)
+    mean = attr.ib(default=0.0)
+    m2 = attr.ib(default=0.0)
+
+    @classmethod
+    def from_array(cls, x):
+        x = np.asarray(x, dtype=np.float64)
+        x = x.reshape((-1, x.shape[-1]))
+        mean = x.mean(axis=0)
+        return cls(len(x), mean, ((x - mean)**2).sum(axis=0))
+
+    def __add__(self, other):
+        count = self.count + other.count
+        if self.count == 0 or other.count == 0:
+            return other if self.count == 0 else self
+
+        delta = other.mean - self.mean
+        mean = self.mean + delta * other.count / count
+        m2 = self.m2 + other.m2 + delta**2 * self.count * other.count / count
+        return Moments(count, mean, m2)
+
+    @property
+    def var(self):
+        return self.m2 / self.count
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
@@ -0,0 +1,261 @@
+"""Train many configurations concurrently from one in-memory dataset
+
+The training and testing data are loaded once in the parent process. The
+configurations are then trained by a pool of forked worker processes, which
+share the memory of the parent's data until they modify it. Each
+configuration is written to ``{output_root}/model.{name}/{seed}/`` in the
+same layout as the ``fit_model`` rule of the Snakefile.
+
+`successive_halving` stops the worst configurations early.
+
+Examples
+--------
+>>> data = load_data(paths)
+>>> configs = configurations(config['models'], seeds=range(5), num_epochs=6)
+>>> run_sweep(data['train'], data['test'], configs)
+"""
+import json
+import logging
+import math
+import multiprocessing
+import os
+import traceback
+
+import numpy as np
+import torch
+
+from .data import TrainingData
+from .model import RHS
+from .training import train_multistep_objective
+
+logger = logging.getLogger(__name__)
+
+# the data used by the worker processes. This is set before the pool is
+# forked, so that the workers do not need to load or unpickle it.
+_shared = {}
+
+
+def load_data(paths, test_x=slice(0, 64), train_x=slice(64, None)):
+    """Load the training and testing data for every y row
+
+    Parameters
+    ----------
+    paths : dict
+        the 'tend', 'cent', 'stat', and '2d' netCDF files
+    test_x, train_x : slice
+        the x indices of the testing and training data
+
+    Returns
+    -------
+    data : dict
+        the 'train' and 'test' TrainingData
+    """
+    files = [
+        (paths['tend'], ('FQT', 'FSL')),
+        (paths['cent'], ('QV', 'TABS', 'QN', 'QP', 'QRAD')),
+        (paths['stat'], ('p', 'RHO')),
+        (paths['2d'], ('LHF', 'SHF', 'SOLIN')),
+    ]
+    return TrainingData.from_var_files(
+        files,
+        variables=TrainingData.required_variables(RHS.forcing_names),
+        splits={'train': {'x': train_x}, 'test': {'x': test_x}})
+
+
+def configurations(models, seeds, num_epochs, output_root='data/output',
+                   **kwargs):
+    """Parameters of every model and seed in a sweep
+
+    Parameters
+    ----------
+    models : dict
+        the parameters of each model, e.g. ``config['models']``
+    seeds : sequence of int
+    num_epochs : int
+    output_root : str
+    **kwargs
+        parameters shared by every configuration, e.g. ``cuda``
+
+    Returns
+    -------
+    list of dicts
+        parameters of `train_multistep_objective`, and optionally 'y' and
+        'storage' as for scripts/train_neural_network.py
+    """
+    configs = []
+    for name, params in models.items():
+        for seed in seeds:
+            d = dict(kwargs)
+            d.update(params)
+            d['seed'] = int(seed)
+            d['num_epochs'] = num_epochs
+            d['output_dir'] = f"{output_root}/model.{name}/{seed}/"
+            configs.append(d)
+    return configs
+
+
+def _select(data, params):
+    """Apply the y region and storage options of a configuration"""
+    y = params.pop('y', None)
+    storage = params.pop('storage', None)
+    if params.pop('lazy', False):
+        logger.warning("The data of a sweep are always in memory")
+
+    if y is not None:
+        y = np.asarray(y)
+        data = [d.isel(y=y) for d in data]
+    if storage:
+        data = [d.compact(storage) for d in data]
+    return data
+
+
+def _train(params):
+    params = dict(params)
+    output_dir = params.pop('output_dir')
+    os.makedirs(output_dir, exist_ok=True)
+    try:
+        train, test = _select([_shared['train'], _shared['test']], params)
+        logger.info(f"Training {output_dir}")
+        train_multistep_objective(train, test, output_dir, **params)
+    except Exception:
+        logger.error(f"Training {output_dir} failed:\n" +
+                     traceback.format_exc())
+        return output_dir, False
+    return output_dir, True
+
+
+def run_sweep(train_data, test_data, configs, processes=None, threads=1):
+    """Train several configurations in parallel
+
+    Parameters
+    ----------
+    train_data, test_data : TrainingData
+        the data for every y row. A configuration with a 'y' entry uses a
+        copy of these rows.
+    configs : list of dicts
+        see `configurations`
+    processes : int, optional
+        number of concurrent trainings. Defaults to the number of cores
+        divided by ``threads``.
+    threads : int
+        number of torch threads used by each training
+
+    Returns
+    -------
+    failed : list of str
+        output directories of the configurations which raised an error
+    """
+    if processes is None:
+        processes = max((os.cpu_count() or 1) // threads, 1)
+    processes = min(processes, len(configs))
+    logger.info(f"Training {len(configs)} configurations with {processes} "
+                f"processes")
+
+    _shared.update(train=train_data, test=test_data)
+    ctx = multiprocessing.get_context('fork')
+    failed = []
+    try:
+        with ctx.Pool(processes, initializer=torch.set_num_threads,
+                      initargs=(threads,), maxtasksperchild=1) as pool:
+            for output_dir, ok in pool.imap_unordered(_train, configs):
+                logger.info(f"Finished {output_dir}")
+                if not ok:
+                    failed.append(output_dir)
+    finally:
+        _shared.clear()
+    return failed
+
+
+def rung_epochs(num_epochs, eta=3, min_epochs=1):
+    """Number of epochs trained by the end of each rung
+
+    Examples
+    --------
+    >>> rung_epochs(6)
+    [1, 3, 6]
+    >>> rung_epochs(9, eta=2, min_epochs=2)
+    [2, 4, 8, 9]
+    """
+    rungs = []
+    epochs = min_epochs
+    while epochs < num_epochs:
+        rungs.append(epochs)
+        epochs *= eta
+    return rungs + [num_epochs]
+
+
+def final_test_loss(output_dir):
+    """Test loss recorded by the last call of the monitor"""
+    with open(os.path.join(output_dir, 'loss.json')) as f:
+        return json.load(f)[-1]['test_loss']
+
+
+def successive_halving(train_data, test_data, configs, eta=3, min_epochs=1,
+                       output_root=None, **kwargs):
+    """Train a sweep, stopping the worst configurations after every rung
+
+    All configurations are trained for ``min_epochs``. After every rung,
+    only the best ``1 / eta`` of them by final test loss are promoted to the
+    next rung. A promoted configuration continues from its saved state, and
+    trains ``eta`` times as many epochs in total. The rungs end at the
+    ``num_epochs`` of the configurations.
+
+    Parameters
+    ----------
+    configs : list of dicts
+        see `configurations`. They must have the same ``num_epochs``.
+    eta : int
+    min_epochs : int
+    output_root : str, optional
+        if given, the rungs are summarized in ``{output_root}/halving.json``
+    **kwargs
+        passed to `run_sweep`
+
+    Returns
+    -------
+    rungs : list of dicts
+        the epochs and the test loss of every configuration trained in each
+        rung
+    """
+    num_epochs = {config['num_epochs'] for config in configs}
+    if len(num_epochs) != 1:
+        raise ValueError("The configurations must have the same num_epochs")
+    num_epochs = num_epochs.pop()
+
+    survivors = list(configs)
+    rungs = []
+    start = 0
+    for epochs in rung_epochs(num_epochs, eta, min_epochs):
+        rung = []
+        for config in survivors:
+            # record the test loss at the end of the rung
+            config = dict(config, num_epochs=epochs, start_epoch=start,
+                          final_monitor=True)
+            if start > 0:
+                config['initial_state'] = os.path.join(config['output_dir'],
+                                                       str(start))
+            rung.append(config)
+
+        logger.info(f"Training {len(rung)} configurations to epoch {epochs}")
+        failed = run_sweep(train_data, test_data, rung, **kwargs)
+
+        scores = {}
+        for config in rung:
+            output_dir = config['output_dir']
+            if output_dir not in failed:
+                scores[output_dir] = final_test_loss(output_dir)
+        rungs.append({'epochs': epochs, 'test_loss': scores})
+
+        # promote the best configurations
+        ranked = sorted(scores, key=scores.get)
+        keep = set(ranked[:max(math.ceil(len(ranked) / eta), 1)])
+        survivors = [config for config in survivors
+                     if config['output_dir'] in keep]
+        logger.info(f"Promoting {sorted(keep)}")
+        start = epochs
+
+    if output_root is not None:
+        with open(os.path.join(output_root, 'halving.json'), 'w') as f:
+            json.dump(rungs, f, indent=2)
+
+    return rungs
@@ -7,11 +7,18 @@ import json
 import logging
 import pprint
 
+import numpy as np
 import torch
+import torch.distributed as dist
+from toolz import first
 from torch.autograd import Variable
+from torch.nn.parallel import DistributedDataParallel
 
 from .utils import train
+from .checkpoints import Checkpointer, snapshot
 from . import model
+from .compiled import CompiledStepper
+from .ensemble import EnsembleRHS, ensemble_loss
 
 
 logger = logging.getLogger(__name__)
@@ -19,23 +26,88 @@ logger = logging.getLogger(__name__)
 
 def save(model, path):
     """Save object using torch.save, creating any directories in the path"""
-    try:
-        os.mkdir(os.path.dirname(path))
-    except OSError:
-        pass
-
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
     torch.save(model, path)
 
 
+def _to_device(batch, device):
+    if torch.is_tensor(batch):
+        return batch.to(device)
+    return {key: _to_device(val, device) for key, val in batch.items()}
+
+
+def _split_batch(batch, batch_size):
+    """Split the time-dependent data of a batch along the batch dimension"""
+    n = first(batch['prognostic'].values()).size(1)
+    batch_size = batch_size or n
+    for start in range(0, n, batch_size):
+        chunk = {
+            group: {key: val[:, start:start + batch_size]
+                    for key, val in batch[group].items()}
+            for group in ['prognostic', 'forcing']
+        }
+        chunk['constant'] = batch['constant']
+        yield chunk
+
+
+def evaluate(model, loss_fn, batch, batch_size=None):
+    """Average loss over a pre-collated batch without computing gradients
+
+    The model is evaluated in eval mode, so that the batch norm statistics
+    are neither used from nor accumulated into the testing data. Batch norm
+    then normalizes with its running statistics instead of those of the
+    batch, so these losses are not comparable with the test losses of runs
+    which evaluated the model in training mode.
+
+    Parameters
+    ----------
+    model : nn.Module
+    loss_fn : callable
+        returns the average loss of a batch. This can also be a vector of
+        losses, for instance one for each member of an ensemble.
+    batch : dict
+    batch_size : int, optional
+        if given, the batch is evaluated in chunks of this size. The result is
+        the same because the chunk losses are weighted by their sizes.
+
+    Returns
+    -------
+    float or list of floats
+    """
+    training = model.training
+    model.eval()
+
+    total, count = 0.0, 0
+    try:
+        with torch.no_grad():
+            for chunk in _split_batch(batch, batch_size):
+                n = first(chunk['prognostic'].values()).size(1)
+                total += loss_fn(chunk).double() * n
+                count += n
+    finally:
+        model.train(training)
+    return (total / count).tolist()
+
+
 def train_multistep_objective(train_data, test_data, output_dir,
                               num_epochs=5,
                               num_test_examples=10000,
                               window_size={0: 2, 1: 10, 2: 20},
                               test_window_size=64,
+                              test_batch_size=None,
                               num_samples=None, batch_size=200, lr=0.01,
                               weight_decay=0.0, nsteps=1, nhidden=(256,),
                               cuda=False, pytest=False,
                               precip_positive=False,
+                              y_weights=None,
+                              prefetch=2, num_workers=0,
+                              compile=False,
+                              checkpoint_steps=None, truncate_steps=None,
+                              method='euler',
+                              ensemble_seeds=None,
+                              distributed=False,
+                              initial_state=None, start_epoch=0,
+                              save_interval=500, final_monitor=False,
                               seed=1):
     """Train a single layer perceptron euler time stepping model
 
@@ -51,23 +123,111 @@ def train_multistep_objective(train_data, test_data, output_dir,
         Size of prediction window for training. If this is a dict then the
         window_size of the time stepper will be set to window_size(epoch).
         Default: 10.
+    test_batch_size : int, optional
+        number of testing windows evaluated at once. By default all
+        ``num_test_examples`` are evaluated in one batch.
+    y_weights : sequence, optional
+        relative probability of sampling training windows from each y row.
+        See `lib.torch.datasets.stratified_weights`.
+    prefetch : int
+        number of training batches assembled in a background thread while the
+        current batch is used. Set to 0 to disable.
+    num_workers : int
+        number of worker processes used by the training data loader. This
+        must be 0 for lazy data.
+    compile : bool
+        if True, run the time stepping loop with a TorchScript compiled
+        version of the model (see `lib.torch.compiled.CompiledStepper`).
+    checkpoint_steps : int, optional
+        recompute the rollout in segments of this many time steps during the
+        backward pass to bound the memory used by long windows.
+    truncate_steps : int, optional
+        truncate backpropagation through time every this many time steps.
+    method : str
+        time integration scheme of the model. See `model.ForcedStepper`.
+    ensemble_seeds : sequence of int, optional
+        if given, train one model for each of these seeds at the same time
+        using stacked weights (see `lib.torch.ensemble`). Every member sees
+        the same batches, but is initialized from its own seed. The outputs
+        of each member are saved in ``{output_dir}/{seed}/`` with the same
+        layout as a single model. Adam keeps separate moments for every
+        weight, so each member is optimized as if it was trained alone.
+    distributed : bool
+        if True, train with `torch.distributed` data parallelism on the CPU.
+        The process group is initialized with the gloo backend from the
+        environment variables set by ``torchrun``, unless it already exists.
+        Every training batch is split between the processes, and their
+        gradients are averaged. The batch norm layer normalizes each shard
+        by its own statistics, and the running statistics of rank 0 are
+        copied to the other processes before every step, so the results
+        differ from those of a single process with the same ``batch_size``
+        unless the shards are large. Only rank 0 computes the test loss and
+        saves any output.
+    initial_state : str, optional
+        directory ``{output_dir}/{epoch}`` saved by an earlier run. Training
+        starts from its model, and from its optimizer state if it was saved
+        at the end of that run.
+    start_epoch : int
+        the first epoch to train. The earlier entries of
+        ``{output_dir}/loss.json`` are kept.
+    save_interval : int, optional
+        number of batches between the checkpoints of the full training state
+        in ``{output_dir}/checkpoints/``. These are written in the background.
+        If the directory has a checkpoint of an interrupted run with the same
+        arguments, training resumes from the newest one. The checkpoints are
+        removed at the end of training. If None, no checkpoints are saved or
+        restored.
+    final_monitor : bool
+        if True, the losses at the end of training are appended to
+        ``{output_dir}/loss.json`` with ``epoch=num_epochs``. This is used to
+        compare the configurations of a successive halving sweep.
 
 
     """
 
+    # the arguments are saved as JSON
+    if y_weights is not None:
+        y_weights = np.asarray(y_weights, dtype=float).tolist()
+    if ensemble_seeds is not None:
+        ensemble_seeds = [int(member_seed) for member_seed in ensemble_seeds]
+
     arguments = locals()
     arguments.pop('test_data')
     arguments.pop('train_data')
     logger.info("Called with parameters:\n" + pprint.pformat(arguments))
     logger.info(f"Saving to {output_dir}")
 
-    try:
-        os.mkdir(output_dir)
-    except OSError:
-        pass
-
-
-    json.dump(arguments, open(f"{output_dir}/arguments.json", "w"))
+    # destroy the process group when done if it is created here
+    own_process_group = distributed and not dist.is_initialized()
+    if own_process_group:
+        dist.init_process_group('gloo')
+    if distributed:
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        logger.info(f"Training on rank {rank} of {world_size}")
+    else:
+        rank, world_size = 0, 1
+    # only the main process writes output
+    is_main = rank == 0
+
+    if is_main:
+        try:
+            os.mkdir(output_dir)
+        except OSError:
+            pass
+
+        json.dump(arguments, open(f"{output_dir}/arguments.json", "w"))
+
+    if ensemble_seeds is not None:
+        if compile:
+            raise ValueError("Ensembles cannot be compiled")
+
+    if is_main and ensemble_seeds is not None:
+        for member_seed in ensemble_seeds:
+            member_dir = f"{output_dir}/{member_seed}"
+            os.makedirs(member_dir, exist_ok=True)
+            json.dump(dict(arguments, seed=member_seed,
+                           output_dir=member_dir, ensemble_seeds=None),
+                      open(f"{member_dir}/arguments.json", "w"))
 
     torch.manual_seed(seed)
 
@@ -88,9 +248,8 @@ def train_multistep_objective(train_data, test_data, output_dir,
         dt = dt.cuda()
 
 
-    test_dataset = test_data.torch_dataset(test_window_size)
     # ntrain = len(train_dataset)
-    ntest = len(test_dataset)
+    ntest = test_data.num_windows(test_window_size)
 
     # logging.info(f"Training dataset length: {ntrain}")
     logging.info(f"Testing dataset length: {ntest}")
@@ -99,67 +258,198 @@ def train_multistep_objective(train_data, test_data, output_dir,
     scaler = train_data.scaler()
     loss = train_data.dynamic_loss()
 
-
-    # get testing_loader
-    test_loader = test_data.get_loader(test_window_size,
-                                       num_samples=num_test_examples)
-
     # define the neural network
     m = train_data.get_num_features()
-    rhs = model.RHS(
-        m,
-        hidden=nhidden,
-        scaler=scaler,
-        precip_positive=precip_positive)
 
+    def make_rhs():
+        return model.RHS(
+            m,
+            hidden=nhidden,
+            scaler=scaler,
+            precip_positive=precip_positive)
+
+    if ensemble_seeds is None:
+        rhs = make_rhs()
+    else:
+        members = []
+        for member_seed in ensemble_seeds:
+            torch.manual_seed(member_seed)
+            members.append(make_rhs())
+        rhs = EnsembleRHS(members)
+        torch.manual_seed(seed)
+
+    # the diagnostics are not used by the loss
     nstepper = model.ForcedStepper(
         rhs,
         h=dt,
-        nsteps=nsteps)
+        nsteps=nsteps,
+        diagnostics=None,
+        checkpoint=checkpoint_steps,
+        truncate=truncate_steps,
+        method=method)
 
     optimizer = torch.optim.Adam(
         rhs.parameters(), lr=lr, weight_decay=weight_decay)
 
+    if initial_state is not None:
+        if ensemble_seeds is not None:
+            raise ValueError("Ensembles cannot be started from a saved state")
+        logger.info(f"Loading the initial state from {initial_state}")
+        nstepper.load_state_dict(
+            torch.load(f"{initial_state}/state.torch")['state'])
+        optimizer_file = f"{initial_state}/optimizer.torch"
+        if os.path.exists(optimizer_file):
+            optimizer.load_state_dict(torch.load(optimizer_file))
+
+    # get testing_loader
+    # collate the testing data once. The windows are a random, but
+    # reproducible, sample, also when they are streamed from lazy data.
+    test_loader = test_data.get_loader(test_window_size,
+                                       num_samples=num_test_examples,
+                                       forcing_names=nstepper.forcing_names,
+                                       shuffle=True, seed=seed)
+    device = next(rhs.parameters()).device
+    if is_main:
+        test_batch = _to_device(next(iter(test_loader)), device)
+
 
     ##
     # model training code below here
     ##
     epoch_data = []
+    loss_file = f"{output_dir}/loss.json"
+    if start_epoch > 0 and os.path.exists(loss_file):
+        epoch_data = [state for state in json.load(open(loss_file))
+                      if state['epoch'] < start_epoch]
 
     def get_generator(epoch):
         T = window_size(epoch)
-        return train_data.get_loader(T, num_samples=num_samples,
-                                     batch_size=batch_size, shuffle=True)
+        logging.info(f"Setting training window size to {T}")
+        nstepper.window_size = T
+        loader = train_data.cached_loader(
+            T, num_samples=num_samples, batch_size=batch_size, shuffle=True,
+            forcing_names=nstepper.forcing_names, y_weights=y_weights,
+            seed=seed, num_workers=num_workers,
+            persistent_workers=num_workers > 0,
+            rank=rank, num_replicas=world_size)
+        # lazy data are shuffled by the dataset itself
+        for sampler in [loader.sampler, getattr(loader.sampler, 'sampler',
+                                                None), loader.dataset]:
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
+        # utils.train starts every epoch with a new running loss
+        train_losses.clear()
+        num_batches[0] = len(loader)
+        return loader
+
+    if compile:
+        logger.info("Compiling the time stepper with TorchScript")
+        stepper_fn = CompiledStepper(nstepper)
+    else:
+        stepper_fn = nstepper
+
+    def get_losses(stepper):
+        if ensemble_seeds is None:
+            def losses(batch):
+                y = stepper(batch)
+                return loss(batch, y)
+            return losses
+        else:
+            return ensemble_loss(loss, stepper, len(ensemble_seeds))
+
+    if distributed:
+        # the linear term of RHS is not used
+        train_stepper = DistributedDataParallel(stepper_fn,
+                                                find_unused_parameters=True)
+    else:
+        train_stepper = stepper_fn
+
+    member_losses = get_losses(train_stepper)
+
+    # the training losses of the ensemble members since the last monitor
+    # call, and the number of batches in the current epoch
+    train_losses = []
+    num_batches = [1]
 
     def closure(batch):
-        y = nstepper(batch)
-        return loss(batch, y)
+        losses = member_losses(batch)
+        if ensemble_seeds is not None:
+            train_losses.append(losses.detach())
+        return losses.sum()
 
     def monitor(state):
-        loss = sum(closure(batch) for batch in test_loader)
-        avg_loss  = loss / len(test_loader)
-        state['test_loss'] = float(avg_loss)
+        state['test_loss'] = evaluate(stepper_fn, get_losses(stepper_fn),
+                                      test_batch, batch_size=test_batch_size)
+        if ensemble_seeds is not None:
+            # normalized like the train_loss of utils.train
+            total = sum(train_losses, torch.zeros(len(ensemble_seeds),
+                                                  device=device))
+            state['member_train_loss'] = (total / num_batches[0]).tolist()
+            train_losses.clear()
         epoch_data.append(state)
         logger.info("Epoch[batch]: {epoch}[{batch}]; Test Loss: {test_loss}; Train Loss: {train_loss}".format(**state))
 
-    def on_epoch_start(epoch):
-        file = f"{output_dir}/{epoch}/state.torch"
+    def saved_models():
+        """Yield the output directory and saved state of every model"""
+        if ensemble_seeds is None:
+            yield output_dir, nstepper.to_saved()
+        else:
+            for e, member_seed in enumerate(ensemble_seeds):
+                member = model.ForcedStepper(
+                    rhs.member(e), h=dt, nsteps=nsteps, method=method)
+                yield f"{output_dir}/{member_seed}", member.to_saved()
+
+    def member_epoch_data(e):
+        """Select the losses of the ``e``-th member from epoch_data"""
+        for state in epoch_data:
+            state = state.copy()
+            state['test_loss'] = state['test_loss'][e]
+            member_train_loss = state.pop('member_train_loss', None)
+            if member_train_loss is not None:
+                state['train_loss'] = member_train_loss[e]
+            yield state
+
+    if save_interval is None:
+        checkpointer = None
+    else:
+        checkpointer = Checkpointer(
+            f"{output_dir}/checkpoints",
+            {'model': nstepper, 'optimizer': optimizer,
+             'epoch_data': epoch_data},
+            interval=save_interval, enabled=is_main, metadata=arguments)
 
+    def on_epoch_start(epoch):
         logging.info(f"Begin epoch {epoch}")
 
-        T = window_size(epoch)
-        logging.info(f"Setting training window size to {T}")
-        nstepper.window_size = T
+        if not is_main:
+            return
 
-        logger.info(f"Saving state to %s" % file)
-
-        save(nstepper.to_saved(), file)
+        for path, saved in saved_models():
+            file = f"{path}/{epoch}/state.torch"
+            logger.info(f"Saving state to %s" % file)
+            if checkpointer is None:
+                save(saved, file)
+            else:
+                checkpointer.write(snapshot(saved), file)
 
     def on_finish():
         import json
+        if checkpointer is not None:
+            checkpointer.close()
+        if not is_main:
+            return
         # torch.save(nstepper, f"{output_dir}/{num_epochs}/model.torch")
-        save(nstepper.to_saved(), f"{output_dir}/{num_epochs}/state.torch")
-        json.dump(epoch_data, open(f"{output_dir}/loss.json", "w"))
+        for path, saved in saved_models():
+            save(saved, f"{path}/{num_epochs}/state.torch")
+        if ensemble_seeds is None:
+            # allows training to continue from this state
+            save(optimizer.state_dict(),
+                 f"{output_dir}/{num_epochs}/optimizer.torch")
+        json.dump(epoch_data, open(loss_file, "w"))
+        if ensemble_seeds is not None:
+            for e, member_seed in enumerate(ensemble_seeds):
+                json.dump(list(member_epoch_data(e)),
+                          open(f"{output_dir}/{member_seed}/loss.json", "w"))
 
     def on_error(data):
         logging.critical("Dumping data to \"dump.pt\"")
@@ -168,15 +458,27 @@ def train_multistep_objective(train_data, test_data, output_dir,
             "model": nstepper,
         }, "dump.pt")
 
-    train(
-        get_generator,
-        closure,
-        optimizer=optimizer,
-        monitor=monitor,
-        num_epochs=num_epochs,
-        on_epoch_start=on_epoch_start,
-        on_finish=on_finish,
-        on_error=on_error)
+    try:
+        train(
+            get_generator,
+            closure,
+            optimizer=optimizer,
+            monitor=monitor if is_main else None,
+            num_epochs=num_epochs,
+            on_epoch_start=on_epoch_start,
+            on_finish=on_finish,
+            on_error=on_error,
+            prefetch=prefetch,
+            start_epoch=start_epoch,
+            checkpointer=checkpointer,
+            final_monitor=final_monitor)
+    finally:
+        # finish writing the checkpoints of an interrupted run
+        if checkpointer is not None:
+            checkpointer.close()
+
+    if own_process_group:
+        dist.destroy_process_group()
 
     training_metadata = {
         'args': arguments,
@@ -1,16 +1,95 @@
 from itertools import islice
+import queue
+import threading
 
 import torch
 from torch.autograd import Variable
 import logging
 from timeit import default_timer as timer
 
+from .checkpoints import rng_state, set_rng_state
+
+
+class Prefetcher(object):
+    """Assemble the batches of an iterable in a background thread
+
+    Up to ``depth`` batches are prepared while the current batch is used for
+    training. The batches are handed over by reference, so no data is copied.
+    When the underlying loader uses worker processes (``num_workers > 0``),
+    its batches are already in shared memory.
+
+    Examples
+    --------
+    >>> list(Prefetcher(range(3)))
+    [0, 1, 2]
+    """
+    _done = object()
+
+    def __init__(self, iterable, depth=2):
+        self.iterable = iterable
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.iterable)
+
+    @staticmethod
+    def _put(batches, stop, item):
+        """Put an item in the queue unless the consumer stops first"""
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, batches, stop):
+        try:
+            for batch in self.iterable:
+                if not self._put(batches, stop, (batch, None)):
+                    return
+            self._put(batches, stop, (self._done, None))
+        except Exception as e:
+            self._put(batches, stop, (self._done, e))
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop),
+                                  daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                batch, error = batches.get()
+                if error is not None:
+                    raise error
+                if batch is self._done:
+                    break
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
 
 
 def train(get_generator, loss_fn, optimizer, num_epochs=1, monitor=None,
-          on_epoch_start=None, on_finish=None, on_error=None):
+          on_epoch_start=None, on_finish=None, on_error=None, prefetch=0,
+          start_epoch=0, checkpointer=None, final_monitor=False):
     """Train a torch model
 
+    The ``monitor`` is called before every 500th batch of each epoch,
+    starting with the first, and with the mean training loss of the batches
+    since its last call.
+
+    If a ``checkpointer`` is given, training resumes from its newest
+    checkpoint of an epoch from ``start_epoch`` to ``num_epochs - 1``. The
+    checkpoints of runs with other arguments are ignored (see
+    `checkpoints.Checkpointer`). The random
+    generators are reset to their state at the start of the interrupted
+    epoch, so that ``get_generator`` produces the same batches, and the
+    batches which were already trained are skipped. ``on_epoch_start`` is not
+    called again for the interrupted epoch.
+
     Parameters
     ----------
     num_epochs : int
@@ -18,20 +97,69 @@ def train(get_generator, loss_fn, optimizer, num_epochs=1, monitor=None,
     num_steps : int or None
         maximum number of batches per epoch. If None, then the full dataset is
         used.
+    prefetch : int
+        number of batches to prepare in the background while training. No
+        prefetching is done if 0.
+    start_epoch : int
+        first epoch to train, e.g. when continuing from a saved model
+    checkpointer : checkpoints.Checkpointer, optional
+        saves the training state at the start of every epoch and every
+        ``checkpointer.interval`` batches. The checkpoints are removed once
+        training is done.
+    final_monitor : bool
+        if True, the ``monitor`` is called once more after the last epoch,
+        with ``epoch=num_epochs`` and ``batch=0``, so that the loss at the
+        end of training is recorded.
     """
     logger = logging.getLogger(__name__)
 
+    checkpoint = checkpointer.latest() if checkpointer else None
+    if checkpoint is not None and not (
+            start_epoch <= checkpoint['epoch'] < num_epochs):
+        logger.info(f"Ignoring the checkpoint of epoch {checkpoint['epoch']}")
+        checkpoint = None
+
+    if checkpoint is not None:
+        logger.info(f"Resuming from epoch {checkpoint['epoch']} and batch "
+                    f"{checkpoint['batch']}")
+        checkpointer.restore(checkpoint)
+        start_epoch = checkpoint['epoch']
+        set_rng_state(checkpoint['epoch_rng'])
+
+    def save_checkpoint(epoch, batch, epoch_rng, avg_loss):
+        if checkpointer:
+            checkpointer.save({'epoch': epoch, 'batch': batch,
+                               'epoch_rng': epoch_rng,
+                               'avg_loss': float(avg_loss)})
+
     t_begin_train = timer()
-    for epoch in range(num_epochs):
+    avg_loss, num_steps = 0, 1
+    for epoch in range(start_epoch, num_epochs):
         avg_loss = 0
-        if on_epoch_start:
-            on_epoch_start(epoch)
+        epoch_rng = rng_state()
+        resumed = checkpoint is not None and epoch == start_epoch
+        if resumed:
+            avg_loss = checkpoint['avg_loss']
+        else:
+            if on_epoch_start:
+                on_epoch_start(epoch)
+            save_checkpoint(epoch, 0, epoch_rng, avg_loss)
 
         data_loader = get_generator(epoch)
+        if prefetch:
+            data_loader = Prefetcher(data_loader, depth=prefetch)
         num_steps = len(data_loader)
 
+        batches = enumerate(data_loader)
+        if resumed:
+            # the batches are loaded, but not trained on
+            for _ in islice(batches, checkpoint['batch']):
+                pass
+            # continue the random sequence of the interrupted run
+            set_rng_state(checkpoint['rng'])
+
         t_start = timer()
-        for batch_idx, data in enumerate(data_loader):
+        for batch_idx, data in batches:
             if batch_idx % 500 == 0:
                 avg_loss /= num_steps
                 if monitor:
@@ -56,12 +184,23 @@ def train(get_generator, loss_fn, optimizer, num_epochs=1, monitor=None,
 
             avg_loss += loss.data.cpu().numpy()
 
+            if checkpointer and (batch_idx + 1) % checkpointer.interval == 0:
+                save_checkpoint(epoch, batch_idx + 1, epoch_rng, avg_loss)
+
             if batch_idx % 200 == 99:
                 t_end = timer()
                 logger.debug(f"{batch_idx}/{len(data_loader)} batches done. "
                              f"Rate: {200/(t_end-t_start):.2f} batch/sec")
                 t_start = timer()
 
+    if final_monitor and monitor and start_epoch < num_epochs:
+        monitor({'epoch': num_epochs,
+                 'train_loss': float(avg_loss / num_steps),
+                 'batch': 0})
+
     logging.info("Done Training. Time elapsed {}".format(timer()-t_begin_train))
     if on_finish:
         on_finish()
+    if checkpointer:
+        # the checkpoints are only needed to resume an interrupted run
+        checkpointer.clear()
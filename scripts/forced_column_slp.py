@@ -1,7 +1,8 @@
 import numpy as np
 import xarray as xr
 import torch
-from lib.torch import column_run, ForcedStepper, TrainingData
+from lib.torch import (column_run, ForcedStepper, TrainingData,
+                       optimize_for_inference)
 import torch
 import logging
 from toolz.curried import valmap
@@ -26,7 +27,7 @@ nt, ny, nx, nz = data.FQT.shape
 loader = data.get_loader(nt, batch_size=ny * nx * nz, shuffle=False)
 input_data = first(loader)
 
-model = ForcedStepper.from_file(state)
+model = optimize_for_inference(ForcedStepper.from_file(state))
 model.eval()
 
 model.nsteps = 1
@@ -0,0 +1,28 @@
+"""Compare the test errors and throughput of a model with its int8 version
+
+The inputs are the outputs of scripts/test_error.py for the float and
+quantized models. Each error metric is averaged over all of its dimensions.
+"""
+import xarray as xr
+import pandas as pd
+
+
+def summarize(ds):
+    metrics = [key for key in ds.data_vars if key not in ['p', 'w']]
+    return pd.Series({key: float(ds[key].mean()) for key in metrics})
+
+
+def report(float_path, int8_path):
+    base = summarize(xr.open_dataset(float_path))
+    quant = summarize(xr.open_dataset(int8_path))
+    df = pd.DataFrame({'float': base, 'int8': quant})
+    df['relative_change'] = (df['int8'] - df['float']) / df['float'].abs()
+    return df
+
+
+i = snakemake.input
+df = report(i.float, i.int8)
+print(df)
+print("Speed up of the time stepping: %.2f" %
+      (df.loc['step_throughput', 'int8'] / df.loc['step_throughput', 'float']))
+df.to_csv(snakemake.output[0])
@@ -0,0 +1,36 @@
+"""Train every model and seed of config.yaml from one copy of the data
+
+If the ``eta`` parameter is given, the configurations are trained with
+successive halving, and only the best ones are trained for all the epochs.
+
+See `lib.torch.sweep`.
+"""
+import logging
+
+from lib.torch.sweep import (load_data, configurations, run_sweep,
+                             successive_halving)
+
+handlers = [logging.FileHandler(snakemake.log[0]), logging.StreamHandler()]
+logging.basicConfig(level=logging.INFO, handlers=handlers)
+
+p = snakemake.params
+
+logging.info("Loading training and testing data")
+data = load_data(snakemake.input)
+
+# use the cores given to this job by snakemake
+threads = p.threads
+processes = max(snakemake.threads // threads, 1)
+
+configs = configurations(p.models, range(p.nseeds), p.nepochs, cuda=p.cuda)
+
+eta = p.get('eta', None)
+if eta:
+    successive_halving(data['train'], data['test'], configs, eta=eta,
+                       output_root='data/output', processes=processes,
+                       threads=threads)
+else:
+    failed = run_sweep(data['train'], data['test'], configs,
+                       processes=processes, threads=threads)
+    if failed:
+        raise RuntimeError(f"Training failed for {failed}")
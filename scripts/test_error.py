@@ -1,8 +1,11 @@
+from timeit import default_timer as timer
+
 import torch
 import numpy as np
 import xarray as xr
 from lib.torch import interface
 from lib.torch import ForcedStepper
+from lib.torch.inference import quantize_dynamic
 
 
 def sel(x):
@@ -91,17 +94,56 @@ def get_src_error(model, inputs, forcings):
     return xr.Dataset(data_vars)
 
 
-def main(torch_file, input_path, forcing_path, output):
+def _num_columns(ds):
+    return ds.sizes['time'] * ds.sizes['x'] * ds.sizes['y']
+
+
+def main(torch_file, input_path, forcing_path, output, quantize=False,
+         seed=None):
+    """
+    Parameters
+    ----------
+    quantize : bool
+        if True, evaluate the model with int8 linear layers (see
+        `lib.torch.inference.quantize_dynamic`)
+    seed : int, optional
+        seed for choosing the windows used for the test error, so that the
+        errors of different models are computed on the same windows
+    """
     model = ForcedStepper.load_from_saved(torch.load(torch_file))
+    if quantize:
+        model = quantize_dynamic(model)
+    if seed is not None:
+        np.random.seed(seed)
+
     inputs = xr.open_dataset(input_path).pipe(sel)
     forcings = xr.open_dataset(forcing_path).pipe(sel)
-    test_error = get_test_error(model, inputs, forcings)
+
+    # the column throughput is the number of columns per second of
+    # simulated time steps or source term evaluations
+    nstarts, window_size = 10, 256
+    t_start = timer()
+    test_error = get_test_error(model, inputs, forcings, nstarts=nstarts,
+                                window_size=window_size)
+    step_time = timer() - t_start
+
+    t_start = timer()
     src_error = get_src_error(model, inputs, forcings)
+    src_time = timer() - t_start
+
+    n = _num_columns(inputs.isel(time=slice(0, window_size))) * nstarts
+    throughput = xr.Dataset({
+        'step_throughput': n / step_time,
+        'rhs_throughput': _num_columns(inputs) / src_time,
+    })
 
     return xr.auto_combine((test_error, src_error))\
+             .merge(throughput)\
              .assign(p=inputs.p, w=inputs.w)\
              .to_netcdf(output)
 
 
 i = snakemake.input
-main(i.model, i.inputs, i.forcings, output=snakemake.output[0])
+p = snakemake.params
+main(i.model, i.inputs, i.forcings, output=snakemake.output[0],
+     quantize=p.get('quantize', False), seed=p.get('seed', None))
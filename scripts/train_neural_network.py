@@ -1,30 +1,73 @@
-"""
-{sys.executable} scripts/torch_time_series.py multi \
-            --num_epochs 4 --window_size 10 --num_steps 500 --batch_size 100 --learning-rate .010\
---weight_decay 0.00 \
-{input} {output}
+"""Train a neural network
+
+This script is usually run by snakemake (see the fit_model rule). It can also
+be launched directly with the name of a model and a seed from config.yaml,
+e.g. for distributed data parallel training with torchrun::
+
+    torchrun --nproc_per_node 16 scripts/train_neural_network.py global 0
+
+or, across several nodes, by running this on each node::
+
+    torchrun --nnodes 4 --nproc_per_node 16 --rdzv_backend c10d \
+        --rdzv_endpoint $HEAD_NODE:29500 \
+        scripts/train_neural_network.py global 0
 """
 import xarray as xr
 import numpy as np
 import torch
 from lib.torch import train_multistep_objective, TrainingData
-import json, sys
+from lib.torch.model import RHS
+import json, os, sys
 from contextlib import redirect_stdout
 import logging
 
-handlers = [logging.FileHandler(snakemake.log[0]), logging.StreamHandler()]
-logging.basicConfig(level=logging.DEBUG, handlers=handlers)
 
-params = snakemake.params[0]
-i = snakemake.input
+def direct_params():
+    """Inputs and parameters for running outside of snakemake"""
+    import argparse
+    import yaml
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('model', help="key of config['models']")
+    parser.add_argument('seed', type=int)
+    parser.add_argument('--config', default='config.yaml')
+    args = parser.parse_args()
+
+    config = yaml.safe_load(open(args.config))
+    try:
+        model = int(args.model)
+    except ValueError:
+        model = args.model
+
+    params = dict(config['models'][model])
+    params['seed'] = args.seed
+    params['output_dir'] = f"data/output/model.{args.model}/{args.seed}/"
+    os.makedirs(params['output_dir'], exist_ok=True)
+    params['num_epochs'] = config.get('nepochs', 6)
+    # launched with torchrun
+    params['distributed'] = 'WORLD_SIZE' in os.environ
+    return config['paths'], params
+
+
+try:
+    snakemake
+except NameError:
+    i, params = direct_params()
+    handlers = [logging.StreamHandler()]
+else:
+    i = snakemake.input
+    params = snakemake.params[0]
+    handlers = [logging.FileHandler(snakemake.log[0]), logging.StreamHandler()]
+
+logging.basicConfig(level=logging.DEBUG, handlers=handlers)
 
 logging.info("Starting training script")
 
 # define paths
 files = [
-    (i.tend, ('FQT', 'FSL')),
-    (i.cent, ('QV', 'TABS', 'QN', 'QP', 'QRAD')),
-    (i.stat, ('p', 'RHO')),
+    (i['tend'], ('FQT', 'FSL')),
+    (i['cent'], ('QV', 'TABS', 'QN', 'QP', 'QRAD')),
+    (i['stat'], ('p', 'RHO')),
     (i['2d'], ('LHF', 'SHF', 'SOLIN')),
 ]
 
@@ -32,25 +75,26 @@ files = [
 y = params.pop('y', np.r_[:64])
 logging.info(f"Training on y-indices: {y}")
 
-def safesel(da, **kwargs):
-    kwargs['y'] = y
-    sel = {dim: kwargs[dim] for dim in da.dims
-           if dim in kwargs}
-    return da.isel(**sel)
-
-def _train(x):
-    return safesel(x, x=slice(64, None))
+# stream the data from disk rather than loading it into memory
+lazy = params.pop('lazy', False)
 
-def _test(x):
-    return safesel(x, x=slice(0, 64))
+logging.info("Loading training and testing data")
+data = TrainingData.from_var_files(
+    files,
+    variables=TrainingData.required_variables(RHS.forcing_names),
+    isel={'y': y},
+    splits={'train': {'x': slice(64, None)},
+            'test': {'x': slice(0, 64)}},
+    lazy=lazy)
+train, test = data['train'], data['test']
 
+# store the training data with reduced precision
+storage = params.pop('storage', None)
+if storage:
+    logging.info(f"Using {storage} storage for the training data")
+    train, test = train.compact(storage), test.compact(storage)
 
-logging.info("Loading training data")
-train = TrainingData.from_var_files(files, post=_train)
 logging.info("Size of training dataset: %.2f MB"%(train.nbytes/1e6))
-
-logging.info("Loading testing data")
-test = TrainingData.from_var_files(files, post=_test)
 logging.info("Size of testing dataset: %.2f MB"%(test.nbytes/1e6))
 
 logging.info("Calling train_multistep_objective")
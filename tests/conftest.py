@@ -0,0 +1,78 @@
+"""Fixtures shared by the test modules"""
+import numpy as np
+import pytest
+import torch
+
+from lib.torch.data import TrainingData
+from lib.torch.model import RHS, ForcedStepper
+from lib.torch.normalization import scaler
+
+nz = 34
+
+
+def _random_inputs(batch=5, nt=3, seed=0):
+    torch.manual_seed(seed)
+    prog = {'sl': 300 + torch.rand(nt, batch, nz),
+            'qt': 10 * torch.rand(nt, batch, nz)}
+    forcing = {'sl': torch.randn(nt, batch, nz),
+               'qt': torch.randn(nt, batch, nz),
+               'SHF': 10 * torch.rand(nt, batch, 1),
+               'LHF': 100 * torch.rand(nt, batch, 1),
+               'SOLIN': 300 * torch.rand(nt, batch, 1)}
+    constant = {'w': torch.rand(nz) + 1, 'z': torch.arange(nz).float()}
+    return {'prognostic': prog, 'forcing': forcing, 'constant': constant}
+
+
+def _random_training_data(nt=5, ny=3, nx=4, nz=nz):
+    rng = np.random.RandomState(0)
+
+    def field(*shape):
+        return rng.rand(*shape).astype(np.float32)
+
+    return TrainingData(
+        qt=field(nt, ny, nx, nz),
+        sl=field(nt, ny, nx, nz),
+        FQT=field(nt, ny, nx, nz),
+        FSL=field(nt, ny, nx, nz),
+        SHF=field(nt, ny, nx),
+        LHF=field(nt, ny, nx),
+        QRAD=field(nt, ny, nx, nz),
+        SOLIN=field(nt, ny, nx),
+        layer_mass=field(nz) + 1,
+        z=np.arange(nz, dtype=np.float32),
+        p=np.arange(nz, dtype=np.float32),
+        x=np.arange(nx, dtype=np.float32),
+        y=np.arange(ny, dtype=np.float32),
+        time=np.arange(nt, dtype=np.float32))
+
+
+@pytest.fixture()
+def random_inputs():
+    """Function returning random inputs of `ForcedStepper` with nz levels"""
+    return _random_inputs
+
+
+@pytest.fixture()
+def random_training_data():
+    """Function returning random `TrainingData`"""
+    return _random_training_data
+
+
+@pytest.fixture()
+def data():
+    return _random_training_data()
+
+
+@pytest.fixture()
+def stepper():
+    torch.manual_seed(1)
+    means = {'sl': 300 + torch.rand(nz), 'qt': 5 + torch.rand(nz)}
+    scales = {'sl': torch.tensor(2.0), 'qt': torch.tensor(3.0)}
+    rhs = RHS(2 * nz, hidden=(16,), scaler=scaler(scales, means),
+              precip_positive=True)
+    stepper = ForcedStepper(rhs, h=torch.tensor([.125]), nsteps=2)
+
+    # accumulate some batch norm statistics
+    with torch.no_grad():
+        stepper(_random_inputs(batch=20, seed=2))
+    return stepper.eval()
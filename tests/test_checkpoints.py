@@ -0,0 +1,110 @@
+import os
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch import nn
+from torch.utils.data import DataLoader, TensorDataset
+
+from lib.torch.checkpoints import Checkpointer
+from lib.torch.utils import train
+
+
+class Interrupt(Exception):
+    pass
+
+
+def _fit(directory, interrupt_at=None, lr=.01):
+    torch.manual_seed(0)
+    x = torch.randn(40, 3)
+    y = x @ torch.tensor([1.0, -2.0, 3.0])
+    dataset = TensorDataset(x, y)
+    model = nn.Linear(3, 1)
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    history = []
+    checkpointer = Checkpointer(directory, {'model': model,
+                                            'optimizer': optimizer,
+                                            'history': history},
+                                interval=3, metadata={'lr': lr})
+    count = [0]
+
+    def get_generator(epoch):
+        # the batches are shuffled by the global random generator
+        return DataLoader(dataset, batch_size=4, shuffle=True)
+
+    def loss_fn(batch):
+        if count[0] == interrupt_at:
+            raise Interrupt
+        count[0] += 1
+        x, y = batch
+        # a random perturbation, which must continue from the same state
+        noise = .01 * torch.randn(1)
+        return ((model(x)[:, 0] + noise - y)**2).mean()
+
+    try:
+        train(get_generator, loss_fn, optimizer, num_epochs=3,
+              monitor=history.append, checkpointer=checkpointer)
+    finally:
+        checkpointer.close()
+    return model, history, count[0]
+
+
+def test_resume(tmpdir):
+    expected, expected_history, _ = _fit(str(tmpdir.join('a')))
+
+    path = str(tmpdir.join('b'))
+    with pytest.raises(Interrupt):
+        _fit(path, interrupt_at=17)
+    # the newest checkpoint is after batch 16, i.e. the 6th of epoch 1
+    assert os.path.basename(Checkpointer(path, {}).paths()[0]) == \
+        'checkpoint.1.6.torch'
+
+    # a run with other arguments does not use the checkpoints
+    assert Checkpointer(path, {}, metadata={'lr': .5}).latest() is None
+
+    # a corrupt checkpoint is skipped
+    with open(os.path.join(path, 'checkpoint.1.6.torch'), 'w') as f:
+        f.write("truncated")
+
+    model, history, count = _fit(path)
+    assert count == 30 - 13
+    assert history == expected_history
+    torch.testing.assert_close(model.weight, expected.weight)
+
+    # the checkpoints are removed when training is done
+    assert Checkpointer(path, {}).paths() == []
+
+
+def _latest_on_rank(rank, directories, store):
+    dist.init_process_group('gloo', init_method=f"file://{store}",
+                            rank=rank, world_size=2)
+    try:
+        checkpointer = Checkpointer(directories[rank], {},
+                                    enabled=rank == 0)
+        checkpoint = checkpointer.latest()
+        assert (checkpoint['epoch'], checkpoint['batch']) == (1, 3)
+        # the checkpoints are only removed once every process is done
+        checkpointer.clear()
+    finally:
+        dist.destroy_process_group()
+
+
+@pytest.mark.skipif(not dist.is_available(), reason="no torch.distributed")
+def test_latest_distributed(tmpdir):
+    path = str(tmpdir.join('checkpoints'))
+    checkpointer = Checkpointer(path, {})
+    checkpointer.save({'epoch': 1, 'batch': 3})
+    checkpointer.close()
+
+    # rank 1 sees a newer checkpoint, as if it listed the files while rank 0
+    # was writing it, but must resume from the one chosen by rank 0
+    other = str(tmpdir.join('other'))
+    checkpointer = Checkpointer(other, {})
+    checkpointer.save({'epoch': 2, 'batch': 0})
+    checkpointer.close()
+
+    mp.start_processes(_latest_on_rank,
+                       args=([path, other], str(tmpdir.join('store'))),
+                       nprocs=2, start_method='fork')
+    assert Checkpointer(path, {}).paths() == []
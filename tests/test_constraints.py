@@ -1,4 +1,5 @@
-from lib.torch.constraints import apply_linear_constraint
+from lib.torch.constraints import (apply_linear_constraint, LinearConstraints,
+                                   ConstraintCache)
 import numpy as np
 import torch
 from torch.autograd import Variable
@@ -29,6 +30,52 @@ def test_apply_linear_constraint():
     assert y.size() == x.size()
 
 
+def test_linear_constraints():
+    torch.manual_seed(0)
+    w = torch.rand(10)
+    x = torch.randn(5, 10)
+    b = torch.randn(5, 1)
+
+    # agrees with apply_linear_constraint
+    con = LinearConstraints(w[None], torch.ones(1, 10), inequality=True)
+    expected = apply_linear_constraint(lambda x: x @ w[:, None], b, x,
+                                       inequality=True)
+    np.testing.assert_allclose(con(x, b).numpy(), expected.numpy(),
+                               rtol=1e-5, atol=1e-6)
+
+    # an equality and an inequality constraint at once
+    A = torch.zeros(2, 10)
+    A[0, :5] = w[:5]
+    A[1, 5:] = w[5:]
+    con = LinearConstraints(A, inequality=[False, True])
+    b = torch.randn(5, 2)
+    y = con(x, b) @ A.t()
+    lhs = x @ A.t()
+    np.testing.assert_allclose(y[:, 0].numpy(), b[:, 0].numpy(), atol=1e-5)
+    np.testing.assert_allclose(y[:, 1].numpy(),
+                               torch.max(lhs[:, 1], b[:, 1]).numpy(),
+                               atol=1e-5)
+
+
+def test_constraint_cache():
+    calls = []
+
+    def build(w):
+        calls.append(w)
+        return w.sum()
+
+    cache = ConstraintCache(build)
+    w = torch.ones(3)
+    cache(w)
+    cache(w)
+    cache(w.clone())
+    assert len(calls) == 1
+
+    w[0] = 2
+    assert float(cache(w)) == 4.0
+    assert len(calls) == 2
+
+
 @pytest.mark.skip()
 def test_precip_functional():
     lhf = torch.FloatTensor([1, 10]).unsqueeze(-1)
@@ -0,0 +1,93 @@
+import copy
+
+import numpy as np
+import torch
+
+from lib.torch.model import RHS, ForcedStepper
+from lib.torch.normalization import scaler
+from lib.torch.loss import dynamic_loss
+from lib.torch.ensemble import EnsembleRHS, ensemble_loss
+
+
+def _members(n, nz):
+    torch.manual_seed(n)
+    means = {'sl': 300 + torch.rand(nz), 'qt': 5 + torch.rand(nz)}
+    scales = {'sl': torch.tensor(2.0), 'qt': torch.tensor(3.0)}
+    members = []
+    for seed in range(n):
+        torch.manual_seed(seed)
+        members.append(RHS(2 * nz, hidden=(16,), scaler=scaler(scales, means),
+                           precip_positive=True))
+    return members
+
+
+def test_ensemble_matches_members(random_inputs):
+    n = 3
+    data = random_inputs()
+    nz = data['prognostic']['sl'].size(-1)
+    members = _members(n, nz)
+    ens = EnsembleRHS(copy.deepcopy(members))
+    weights = {'sl': torch.ones(nz), 'qt': torch.ones(nz)}
+
+    def loss(batch, y):
+        return dynamic_loss(batch, y, weights=weights)
+
+    def stepper(rhs):
+        return ForcedStepper(rhs, h=torch.tensor([.125]), nsteps=2,
+                             diagnostics=None)
+
+    losses = ensemble_loss(loss, stepper(ens), n)(data)
+    losses.sum().backward()
+
+    for e, rhs in enumerate(members):
+        expected = loss(data, stepper(rhs)(data))
+        expected.backward()
+        np.testing.assert_allclose(losses[e].item(), expected.item(),
+                                   rtol=1e-5)
+
+        # the gradients and batch norm statistics of each member are its own
+        np.testing.assert_allclose(ens.mlp[0].weight.grad[e].t().numpy(),
+                                   rhs.mlp[0].weight.grad.numpy(),
+                                   rtol=1e-4, atol=1e-6)
+        np.testing.assert_allclose(ens.member(e).bn.running_mean.numpy(),
+                                   rhs.bn.running_mean.numpy(), rtol=1e-5)
+        np.testing.assert_allclose(ens.member(e).bn.running_var.numpy(),
+                                   rhs.bn.running_var.numpy(), rtol=1e-5)
+
+    # the members can be extracted and saved as ordinary models
+    saved = stepper(ens.member(1)).to_saved()
+    loaded = ForcedStepper.load_from_saved(saved).eval()
+    members[1].eval()
+    with torch.no_grad():
+        np.testing.assert_allclose(
+            loaded(data)['prognostic']['qt'].numpy(),
+            stepper(members[1])(data)['prognostic']['qt'].numpy(), rtol=1e-4,
+            atol=1e-6)
+
+
+def test_train_ensemble(random_training_data, tmpdir):
+    import json
+
+    import attr
+
+    from lib.torch.training import train_multistep_objective
+
+    data = attr.evolve(random_training_data(nt=6, nx=6), QRAD=None)
+    # the windows are sampled by the seed, so that both runs see the same
+    # batches
+    kwargs = dict(num_epochs=2, nhidden=(8,), window_size=2, batch_size=8,
+                  num_samples=32, test_window_size=3, num_test_examples=10,
+                  prefetch=0, seed=1, save_interval=None)
+
+    train_multistep_objective(data, data, str(tmpdir.join('single')),
+                              **kwargs)
+    train_multistep_objective(data, data, str(tmpdir.join('ensemble')),
+                              ensemble_seeds=range(1, 3), **kwargs)
+
+    # the members record the same losses as a model trained alone
+    single = json.load(open(str(tmpdir.join('single', 'loss.json'))))
+    member = json.load(open(str(tmpdir.join('ensemble', '1', 'loss.json'))))
+    for key in ['train_loss', 'test_loss']:
+        np.testing.assert_allclose([state[key] for state in member],
+                                   [state[key] for state in single],
+                                   rtol=1e-4)
@@ -0,0 +1,200 @@
+import numpy as np
+import pytest
+import torch
+
+from lib.torch.model import adaptive_heun_step, pack_forcing
+from lib.torch.inference import optimize_for_inference, quantize_dynamic
+from lib.torch.compiled import CompiledStepper
+
+def test_optimize_for_inference(stepper, random_inputs):
+    data = random_inputs()
+
+    # the mode of the trained model is not changed
+    stepper.train()
+    fast = optimize_for_inference(stepper)
+    assert stepper.training
+    stepper.eval()
+
+    with torch.no_grad():
+        expected = stepper(data)
+        out = fast(data)
+        # the packed buffer is reused
+        out = fast(data)
+
+    for key in ['sl', 'qt']:
+        np.testing.assert_allclose(out['prognostic'][key].numpy(),
+                                   expected['prognostic'][key].numpy(),
+                                   rtol=1e-4)
+
+
+def test_compiled_stepper(stepper, random_inputs):
+    data = random_inputs()
+    compiled = CompiledStepper(stepper)
+
+    for mode in [False, True]:
+        stepper.train(mode)
+        compiled.train(mode)
+        expected = stepper(data)
+        out = compiled(data)
+
+        for key in ['sl', 'qt']:
+            np.testing.assert_allclose(
+                out['prognostic'][key].detach().numpy(),
+                expected['prognostic'][key].detach().numpy(), rtol=1e-4)
+
+    stepper.truncate = 2
+    with pytest.raises(ValueError):
+        CompiledStepper(stepper)
+
+    # gradients flow to the parameters of the original model
+    out['prognostic']['qt'].sum().backward()
+    assert stepper.rhs.mlp[0].weight.grad is not None
+
+
+def test_forward_packed(stepper, random_inputs):
+    data = random_inputs()
+    expected = stepper(data)
+
+    prog = data['prognostic']
+    state = torch.cat((prog['sl'][0], prog['qt'][0]), -1)
+    forcing, layout = pack_forcing(data['forcing'], stepper.forcing_names)
+
+    # the in-place updates without gradients give the same answer
+    with torch.no_grad():
+        steps = stepper.forward_packed(state, forcing, layout,
+                                       data['constant']['w'])
+        y = stepper(data)
+
+    expected = torch.cat((expected['prognostic']['sl'],
+                          expected['prognostic']['qt']), -1)
+    np.testing.assert_allclose(steps.numpy(), expected.detach().numpy(),
+                               rtol=1e-6)
+    nz = state.size(-1) // 2
+    np.testing.assert_allclose(y['prognostic']['qt'].numpy(),
+                               steps[..., nz:].numpy())
+
+
+def test_diagnostics_modes(stepper, random_inputs):
+    data = random_inputs()
+    with torch.no_grad():
+        step = stepper(data)['diagnostic']
+        stepper.diagnostics = 'window'
+        window = stepper(data)['diagnostic']
+        stepper.diagnostics = None
+        assert stepper(data)['diagnostic'] == {}
+
+    assert set(step) == {'QLSF', 'QNN', 'SLSF', 'SNN'}
+    for key in step:
+        assert step[key].shape == (2, 5, 1)
+        np.testing.assert_allclose(window[key].numpy(), step[key].numpy(),
+                                   rtol=1e-3, atol=1e-6)
+
+
+def test_checkpoint(stepper, random_inputs):
+    data = random_inputs(nt=5)
+    stepper.diagnostics = None
+
+    def grad():
+        stepper.zero_grad()
+        y = stepper(data)
+        y['prognostic']['qt'].sum().backward()
+        return y['prognostic']['qt'].detach(), stepper.rhs.mlp[0].weight.grad
+
+    qt, expected = grad()
+
+    stepper.checkpoint = 2
+    qt_checkpoint, g = grad()
+    np.testing.assert_allclose(qt_checkpoint.numpy(), qt.numpy(), rtol=1e-6)
+    np.testing.assert_allclose(g.numpy(), expected.numpy(), rtol=1e-4,
+                               atol=1e-6)
+
+    stepper.truncate = 1
+    _, g = grad()
+    assert not np.allclose(g.numpy(), expected.numpy())
+
+
+@pytest.mark.parametrize('method', ['heun', 'rk4', 'adaptive'])
+def test_integrators(stepper, method, random_inputs):
+    data = random_inputs()
+    stepper.diagnostics = None
+
+    def run(method, nsteps):
+        stepper.method, stepper.nsteps = method, nsteps
+        with torch.no_grad():
+            return stepper(data)['prognostic']['qt'].numpy()
+
+    reference = run('euler', 200)
+    euler_err = np.abs(run('euler', 2) - reference).max()
+    stepper.rtol, stepper.atol = 1e-5, 1e-7
+    err = np.abs(run(method, 2) - reference).max()
+    assert err < euler_err
+
+    # the gradient enabled path gives the same answer
+    y = stepper(data)['prognostic']['qt'].detach().numpy()
+    np.testing.assert_allclose(y, run(method, 2), rtol=1e-5, atol=1e-6)
+
+
+def test_adaptive_heun_step():
+    def f(x):
+        return -x
+
+    x = torch.ones(3)
+    y = adaptive_heun_step(f, x, 1.0, .1, rtol=1e-6, atol=1e-8)
+    np.testing.assert_allclose(y.numpy(), np.exp(-1), rtol=1e-4)
+
+    # the substeps are too small to reach h
+    with pytest.raises(RuntimeError):
+        adaptive_heun_step(f, x, 1.0, .1, rtol=1e-6, atol=1e-8,
+                           max_substeps=5)
+
+
+def test_quantize_dynamic(stepper, random_inputs):
+    data = random_inputs()
+    stepper.train()
+    quantized = quantize_dynamic(stepper)
+    assert stepper.training
+    stepper.eval()
+    assert not any(isinstance(layer, torch.nn.Linear)
+                   for layer in quantized.rhs.mlp)
+
+    with torch.no_grad():
+        expected = stepper(data)['prognostic']['qt'].numpy()
+        out = quantized(data)['prognostic']['qt'].numpy()
+    np.testing.assert_allclose(out, expected, rtol=.05, atol=.05)
+
+
+def _to_dataset(fields, z):
+    import xarray as xr
+
+    data_vars = {}
+    for key, val in fields.items():
+        val = val.numpy()
+        if val.shape[-1] == 1:
+            data_vars[key] = (['time', 'x'], val[..., 0])
+        else:
+            data_vars[key] = (['time', 'x', 'z'], val)
+    return xr.Dataset(data_vars, coords={'z': z.numpy(),
+                                         'time': np.arange(val.shape[0])})
+
+
+def test_column_run(stepper, random_inputs):
+    from lib.torch.interface import column_run, rhs
+
+    data = random_inputs()
+    w, z = data['constant']['w'], data['constant']['z']
+    prognostic = _to_dataset(data['prognostic'], z)
+    prognostic['w'] = ('z', w.numpy())
+    prognostic['p'] = ('z', z.numpy())
+    forcing = _to_dataset(data['forcing'], z)
+
+    # the layer mass has a batch dimension of size 1
+    out = column_run(stepper, prognostic, forcing)
+    with torch.no_grad():
+        expected = stepper(data)
+    for key in ['sl', 'qt']:
+        np.testing.assert_allclose(
+            out[key].transpose('time', 'x', 'z').values,
+            expected['prognostic'][key].numpy(), rtol=1e-5)
+
+    src = rhs(stepper, prognostic, forcing)
+    assert dict(src['qt'].sizes) == dict(prognostic['qt'].sizes)
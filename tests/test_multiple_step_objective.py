@@ -15,3 +15,28 @@ def test__fix_moisture():
 
     np.testing.assert_allclose((q *w).sum(), (q_new * w).sum())
     assert (q_new > 0).all()
+
+
+def test_train_arguments(random_training_data, tmpdir):
+    import json
+
+    import attr
+
+    from lib.torch.training import train_multistep_objective
+
+    data = attr.evolve(random_training_data(nt=6, nx=6), QRAD=None)
+    # the arguments are saved as JSON
+    train_multistep_objective(data, data, str(tmpdir), num_epochs=1,
+                              nhidden=(8,), window_size=2, batch_size=8,
+                              test_window_size=3, num_test_examples=10,
+                              y_weights=np.array([1, 1, 2]), prefetch=0)
+    args = json.load(open(str(tmpdir.join('arguments.json'))))
+    assert args['y_weights'] == [1, 1, 2]
+
+
+def test_save_bare_filename(tmpdir, monkeypatch):
+    from lib.torch.training import save
+
+    monkeypatch.chdir(tmpdir)
+    save({'a': 1}, 'model.torch')
+    assert torch.load('model.torch') == {'a': 1}
@@ -0,0 +1,39 @@
+import subprocess
+import sys
+
+import numpy as np
+import torch
+from toolz import valmap
+
+from lib.npmodel import NumpyStepper
+from lib.torch.inference import export_numpy
+
+
+def test_numpy_stepper(stepper, random_inputs, tmpdir):
+    path = str(tmpdir.join("model.npz"))
+    stepper.train()
+    export_numpy(stepper, path)
+    assert stepper.training
+    stepper.eval()
+    model = NumpyStepper.load(path)
+
+    data = random_inputs(nt=4)
+    stepper.diagnostics = 'window'
+    with torch.no_grad():
+        expected = stepper(data)
+
+    data = {group: valmap(lambda x: x.numpy(), data[group]) for group in data}
+    out = model(data)
+
+    # the diagnostics are differences of large column integrals, so they are
+    # more sensitive to round off
+    for group, rtol in [('prognostic', 1e-4), ('diagnostic', 1e-2)]:
+        for key in expected[group]:
+            np.testing.assert_allclose(out[group][key],
+                                       expected[group][key].numpy(),
+                                       rtol=rtol, atol=1e-6)
+
+
+def test_npmodel_does_not_import_torch():
+    code = "import sys, lib.npmodel; assert 'torch' not in sys.modules"
+    subprocess.check_call([sys.executable, "-c", code])
@@ -0,0 +1,54 @@
+import json
+import os
+
+import attr
+
+from lib.torch.sweep import configurations, run_sweep, successive_halving
+
+
+def test_run_sweep(random_training_data, tmpdir):
+    data = attr.evolve(random_training_data(nt=6, nx=6), QRAD=None)
+    models = {'a': {'nhidden': [8], 'window_size': 2, 'y': [0, 1]},
+              'b': {'nhidden': [4], 'window_size': 3, 'lr': .001}}
+    configs = configurations(models, seeds=[0, 1], num_epochs=1,
+                             output_root=str(tmpdir), batch_size=8,
+                             test_window_size=3, num_test_examples=10,
+                             prefetch=0)
+    assert len(configs) == 4
+
+    failed = run_sweep(data, data, configs, processes=2)
+    assert failed == []
+
+    for name in models:
+        for seed in [0, 1]:
+            path = str(tmpdir.join(f"model.{name}/{seed}"))
+            for file in ['0/state.torch', '1/state.torch', 'loss.json']:
+                assert os.path.exists(os.path.join(path, file))
+            args = json.load(open(os.path.join(path, 'arguments.json')))
+            assert args['seed'] == seed
+            # only the monitor calls during training are recorded
+            epochs = [state['epoch'] for state in
+                      json.load(open(os.path.join(path, 'loss.json')))]
+            assert epochs == [0]
+
+
+def test_successive_halving(random_training_data, tmpdir):
+    data = attr.evolve(random_training_data(nt=6, nx=6), QRAD=None)
+    models = {'a': {'lr': .01}, 'b': {'lr': 1e-5}, 'c': {'lr': .001}}
+    configs = configurations(models, seeds=[0], num_epochs=3,
+                             output_root=str(tmpdir), nhidden=[8],
+                             window_size=2, batch_size=8, test_window_size=3,
+                             num_test_examples=10, prefetch=0)
+
+    rungs = successive_halving(data, data, configs, eta=2, processes=3,
+                               output_root=str(tmpdir))
+    assert [rung['epochs'] for rung in rungs] == [1, 2, 3]
+    assert [len(rung['test_loss']) for rung in rungs] == [3, 2, 1]
+
+    # the promoted configuration continued from its saved state
+    best = next(iter(rungs[-1]['test_loss']))
+    assert os.path.exists(os.path.join(best, '3', 'state.torch'))
+    epochs = [state['epoch'] for state in
+              json.load(open(os.path.join(best, 'loss.json')))]
+    assert epochs == [0, 1, 2, 3]
+    assert os.path.exists(str(tmpdir.join('halving.json')))
@@ -0,0 +1,208 @@
+import attr
+import numpy as np
+import pytest
+import torch
+import xarray as xr
+
+from lib.torch.data import TrainingData
+
+
+def test_memmap_round_trip(data, tmpdir):
+    path = str(tmpdir.join('data'))
+    data.to_memmap(path)
+    loaded = TrainingData.load(path)
+
+    assert isinstance(loaded.qt, np.memmap)
+    for key in ['qt', 'FSL', 'SHF', 'layer_mass', 'time']:
+        np.testing.assert_array_equal(getattr(loaded, key),
+                                      getattr(data, key))
+    assert loaded.nbytes == data.nbytes
+
+
+def test_get_loader(data):
+    nt, ny, nx, nz = data.qt.shape
+    loader = data.get_loader(3, batch_size=4, shuffle=True)
+    batch = next(iter(loader))
+
+    assert batch['prognostic']['qt'].shape == (3, 4, nz)
+    assert batch['forcing']['LHF'].shape == (3, 4, 1)
+    assert set(batch['constant']) == {'w', 'z'}
+    assert len(loader) == (nt - 2) * ny * nx // 4
+
+
+def test_get_loader_lazy(data):
+    da = pytest.importorskip('dask.array')
+    nt, ny, nx, nz = data.qt.shape
+
+    lazy_data = attr.evolve(data, qt=da.from_array(data.qt, chunks=2),
+                            sl=da.from_array(data.sl, chunks=2))
+    assert lazy_data.is_lazy
+
+    loader = lazy_data.get_loader(3, batch_size=5, shuffle=True,
+                                  block_size=2, buffer_blocks=1)
+    batches = list(loader)
+
+    assert len(batches) == len(loader)
+    sizes = [batch['prognostic']['qt'].shape[1] for batch in batches]
+    assert sum(sizes) == data.num_windows(3)
+    assert all(size == 5 for size in sizes[:-1])
+
+    # every window appears exactly once
+    first_times = np.sort(np.concatenate(
+        [batch['forcing']['qt'][0, :, 0].numpy() for batch in batches]))
+    expected = np.sort(data.FQT[:nt - 2, ..., 0].ravel())
+    np.testing.assert_array_equal(first_times, expected)
+
+    # seeded streams are reproducible, but differ between epochs
+    def first_batch(epoch):
+        loader = lazy_data.get_loader(3, batch_size=5, shuffle=True, seed=1,
+                                      block_size=2, buffer_blocks=1)
+        loader.dataset.set_epoch(epoch)
+        return next(iter(loader))['prognostic']['qt'].numpy()
+
+    np.testing.assert_array_equal(first_batch(0), first_batch(0))
+    assert not np.array_equal(first_batch(0), first_batch(1))
+
+    # a shuffled subset is not just the first windows
+    def subset(shuffle):
+        loader = lazy_data.get_loader(3, num_samples=4, shuffle=shuffle,
+                                      seed=1, block_size=2, buffer_blocks=1)
+        return next(iter(loader))['forcing']['qt'][0, :, 0].numpy()
+
+    assert not np.array_equal(np.sort(subset(True)), np.sort(subset(False)))
+
+    with pytest.raises(ValueError):
+        lazy_data.get_loader(3, batch_size=5, y_weights=[1, 1, 2])
+    with pytest.raises(ValueError):
+        lazy_data.get_loader(3, batch_size=5, num_workers=2)
+
+
+def test_statistics(data, tmpdir):
+    moments = data.statistics(chunk_size=2)
+
+    np.testing.assert_allclose(moments['qt'].mean,
+                               data.qt.reshape((-1, 34)).mean(axis=0),
+                               rtol=1e-5)
+    np.testing.assert_allclose(moments['sl'].var,
+                               data.sl.reshape((-1, 34)).var(axis=0),
+                               rtol=1e-4)
+
+    # statistics are cached next to memory mapped data
+    path = str(tmpdir.join('data'))
+    data.to_memmap(path)
+    TrainingData.from_memmap(path).statistics(chunk_size=2)
+    assert tmpdir.join('data', 'statistics.npz').check()
+
+    cached = TrainingData.from_memmap(path).statistics()
+    np.testing.assert_allclose(cached['sl'].m2, moments['sl'].m2)
+
+    # rewriting the directory removes the stale statistics
+    data.to_memmap(path)
+    assert not tmpdir.join('data', 'statistics.npz').check()
+
+    # a truncated cache is recomputed
+    tmpdir.join('data', 'statistics.npz').write('truncated')
+    recomputed = TrainingData.from_memmap(path).statistics()
+    np.testing.assert_allclose(recomputed['sl'].m2, moments['sl'].m2)
+
+
+def test_from_var_files_splits(data, tmpdir):
+    nt, ny, nx, nz = data.qt.shape
+    dims = ['time', 'y', 'x', 'z']
+    coords = {'time': data.time, 'y': data.y, 'x': data.x, 'z': data.z}
+
+    def dataset(**variables):
+        return xr.Dataset({key: (dims[:val.ndim], val)
+                           for key, val in variables.items()},
+                          coords=coords)
+
+    paths = {name: str(tmpdir.join(name + '.nc'))
+             for name in ['tend', 'cent', 'stat', '2d']}
+    dataset(FQT=data.FQT, FSL=data.FSL).to_netcdf(paths['tend'])
+    dataset(QV=data.qt, TABS=data.sl, QN=0 * data.qt, QP=0 * data.qt,
+            QRAD=data.QRAD).to_netcdf(paths['cent'])
+    xr.Dataset({'p': (['z'], data.p),
+                'RHO': (['time', 'z'], np.ones((nt, nz)))},
+               coords={'time': data.time, 'z': data.z}
+               ).to_netcdf(paths['stat'])
+    dataset(LHF=data.LHF, SHF=data.SHF,
+            SOLIN=data.SOLIN).to_netcdf(paths['2d'])
+
+    files = [
+        (paths['tend'], ('FQT', 'FSL')),
+        (paths['cent'], ('QV', 'TABS', 'QN', 'QP', 'QRAD')),
+        (paths['stat'], ('p', 'RHO')),
+        (paths['2d'], ('LHF', 'SHF', 'SOLIN')),
+    ]
+
+    splits = TrainingData.from_var_files(
+        files, isel={'y': [0, 2]},
+        splits={'train': {'x': slice(1, None)}, 'test': {'x': slice(0, 1)}})
+
+    assert splits['train'].FQT.shape == (nt, 2, nx - 1, nz)
+    assert splits['test'].SHF.shape == (nt, 2, 1)
+    np.testing.assert_allclose(splits['test'].qt,
+                               data.qt[:, [0, 2], :1])
+    np.testing.assert_allclose(splits['train'].FSL,
+                               data.FSL[:, [0, 2], 1:])
+
+
+def test_get_loader_forcing_names(data):
+    data = attr.evolve(data, QRAD=None)
+    loader = data.get_loader(3, batch_size=4,
+                             forcing_names=('sl', 'qt', 'LHF'))
+    batch = next(iter(loader))
+    assert set(batch['forcing']) == {'sl', 'qt', 'LHF'}
+
+    with pytest.raises(ValueError):
+        data.get_loader(3, forcing_names=('QRAD',))
+
+
+def test_required_variables():
+    variables = TrainingData.required_variables(('sl', 'qt', 'SHF'))
+    assert {'FSL', 'FQT', 'SHF', 'TABS'} <= variables
+    assert 'QRAD' not in variables
+
+
+@pytest.mark.parametrize('storage', ['float16', 'int16'])
+def test_compact(data, storage, tmpdir):
+    compact = data.compact(storage)
+    assert compact.nbytes < data.nbytes
+    for key in ['qt', 'sl', 'FQT', 'FSL', 'SHF']:
+        val = getattr(compact, key)
+        if storage == 'float16':
+            assert val.dtype == np.float16
+        else:
+            assert val.data.dtype == np.int16
+
+    batch = compact.torch_dataset(3)[[0, 4, 7]]
+    expected = data.torch_dataset(3)[[0, 4, 7]]
+    for key in ['qt', 'sl']:
+        assert batch['prognostic'][key].dtype == torch.float32
+        np.testing.assert_allclose(batch['prognostic'][key].numpy(),
+                                   expected['prognostic'][key].numpy(),
+                                   atol=1e-3)
+
+    path = str(tmpdir.join('data'))
+    compact.to_memmap(path)
+    loaded = TrainingData.from_memmap(path)
+    np.testing.assert_array_equal(loaded.SHF[:], compact.SHF[:])
+
+
+def test_cached_loader(data):
+    loader = data.cached_loader(3, batch_size=4, y_weights=[1, 1, 2])
+    assert data.cached_loader(3, batch_size=4, y_weights=[1, 1, 2]) is loader
+    assert data.cached_loader(2, batch_size=4, y_weights=[1, 1, 2]) \
+        is not loader
+
+
+def test_isel(data):
+    region = data.isel(y=[0, 2], time=slice(1, None))
+    assert region.qt.shape == (4, 2, 4, 34)
+    assert region.SHF.shape == (4, 2, 4)
+    np.testing.assert_array_equal(region.y, [0, 2])
+    np.testing.assert_array_equal(region.LHF, data.LHF[1:, [0, 2]])
+    np.testing.assert_array_equal(region.layer_mass, data.layer_mass)
+
+    compact = data.compact('int16').isel(y=[1])
+    np.testing.assert_allclose(compact.qt[:], data.qt[:, [1]], atol=1e-3)
@@ -1,5 +1,6 @@
+import attr
 import numpy as np
-from lib.torch.datasets import WindowedData
+from lib.torch.datasets import WindowedData, WindowSampler
 
 
 def test_windowed_dataset():
@@ -12,3 +13,42 @@ def test_windowed_dataset():
 
     assert data[0][:, 0].tolist() == [0, 1, 2]
     assert data[1][:, 0].tolist() == [1, 2, 3]
+
+
+def test_windowed_dataset_get_batch():
+    arr = np.random.rand(6, 2, 3, 4)
+    data = WindowedData(arr, chunk_size=3)
+
+    inds = [0, 5, 13, 7]
+    batch = data[inds]
+
+    assert batch.shape == (3, len(inds), 4)
+    for k, ind in enumerate(inds):
+        np.testing.assert_array_equal(batch[:, k].numpy(), data[ind])
+
+
+def test_window_sampler():
+    sampler = WindowSampler(5, 3, 4, num_samples=50, batch_size=20,
+                            weights=[1, 0, 1], seed=1)
+    batches = list(sampler)
+
+    assert len(batches) == len(sampler) == 3
+    assert [len(b) for b in batches] == [20, 20, 10]
+
+    # the middle y row has no weight
+    inds = np.concatenate(batches)
+    iy = (inds // 5) // 4
+    assert set(iy) == {0, 2}
+
+    # deterministic given the seed and epoch
+    np.testing.assert_array_equal(np.concatenate(list(sampler)), inds)
+    sampler.set_epoch(1)
+    assert not np.array_equal(np.concatenate(list(sampler)), inds)
+
+    # the shards of distributed processes split every batch
+    shards = [list(attr.evolve(sampler, rank=rank, num_replicas=2))
+              for rank in range(2)]
+    for batch, parts in zip(list(sampler), zip(*shards)):
+        assert len(parts[0]) == len(parts[1])
+        np.testing.assert_array_equal(np.sort(np.concatenate(parts)),
+                                      np.sort(batch))
@@ -0,0 +1,28 @@
+import time
+
+import pytest
+
+from lib.torch.utils import Prefetcher
+
+
+def test_prefetcher():
+    batches = Prefetcher(range(10), depth=3)
+    assert len(batches) == 10
+    assert list(batches) == list(range(10))
+
+    # stopping early does not hang
+    for i in batches:
+        if i == 2:
+            break
+
+    # stopping while the queue is full does not hang either
+    for i in Prefetcher(range(3), depth=2):
+        time.sleep(.3)
+        break
+
+    def fail():
+        yield 1
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        list(Prefetcher(fail()))